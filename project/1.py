@@ -4,6 +4,7 @@ from LLM import (
     generate_with_openai,
     generate_with_gemini,
     gather_context,
+    gather_contexts,
     extract_questions,
     parse_mc_questions,
     parse_eval,
@@ -11,7 +12,8 @@ from LLM import (
     get_chat_llm,
     hist_pairs,
     hist_text,
-    summarize_docs
+    summarize_docs,
+    category_retriever,
 )
 from langchain.chains import RetrievalQA
 import streamlit.components.v1 as components
@@ -359,7 +361,9 @@ with c1:
 if "vectorstore" not in st.session_state:
     st.info("임베딩 자료가 없습니다. 메인에서 PDF 업로드 → 임베딩 생성 후 이용하세요.")
 else:
-    if "qa_chain" not in st.session_state:
+    # 검색기가 페이지 카테고리에 묶여 있으므로 다른 페이지에서 만든 체인은 다시 만듦
+    if "qa_chain" not in st.session_state or st.session_state.get("qa_category") != CATEGORY_NAME:
+        st.session_state.qa_category = CATEGORY_NAME
         # LLM.py의 함수로 백엔드/모델/LLM 가져옴
         try:
             backend, model = get_llm_backend()   # "openai" | "gemini", 모델 문자열
@@ -373,7 +377,8 @@ else:
             st.error(f"LLM 초기화 실패: {e}")
             llm = None
 
-        retriever = st.session_state.vectorstore.as_retriever(search_kwargs={"k": 4})
+        # 이 페이지 카테고리로 태깅된 청크만 검색
+        retriever = category_retriever(st.session_state.vectorstore, CATEGORY_NAME, k=4)
 
         # PDF우선 PDF에 내용 없으면 LLM이 알아서 답변해줌
         st.session_state.retriever = retriever
@@ -628,7 +633,7 @@ if st.button("랜덤 문제 생성", use_container_width=True):
             with st.status("문제 생성 중...", expanded=True) as status:
                 status.update(label="컨텍스트 수집...", state="running")
                 backend, model = get_llm_backend()
-                context = gather_context(k=6, enabled=with_context, retriever=st.session_state.vectorstore.as_retriever(search_kwargs={"k": 6}) if has_vs else None)
+                context = gather_context(k=6, enabled=with_context, category=CATEGORY_NAME)
 
                 status.update(label="프롬프트 구성...", state="running")
                 if difficulty == "초급":
@@ -693,7 +698,7 @@ if st.button("랜덤 문제 생성", use_container_width=True):
         else:
             bar = st.progress(0)
             backend, model = get_llm_backend(); bar.progress(10)
-            context = gather_context(k=6, enabled=with_context, retriever=st.session_state.vectorstore.as_retriever(search_kwargs={"k": 6}) if has_vs else None); bar.progress(20)
+            context = gather_context(k=6, enabled=with_context, category=CATEGORY_NAME); bar.progress(20)
             if difficulty == "초급":
                 prompt = QUIZ_PROMPT_MC.format(category=CATEGORY_NAME, n_items=n_items, context=(f"[컨텍스트]\n{context}" if context else "(컨텍스트 없음)"))
             else:
@@ -754,9 +759,11 @@ if items:
         # 채점
         if st.button("채점하기", type="primary", use_container_width=True):
             backend, model = get_llm_backend()
-            context = gather_context(k=6, enabled=with_context, retriever=st.session_state.vectorstore.as_retriever(search_kwargs={"k": 6}) if has_vs else None)
+            # 문항별 근거를 한 번의 배치 검색으로 가져옴
+            contexts = gather_contexts(items, k=6, enabled=with_context, category=CATEGORY_NAME)
             results = []
             for i, qtext in enumerate(items):
+                context = contexts[i]
                 ans = st.session_state.get(f"{CATEGORY_NAME}_ans_{i}", "").strip()
                 eval_prompt = EVAL_PROMPT_TMPL.format(
                     category=CATEGORY_NAME,
@@ -2,16 +2,33 @@ from __future__ import annotations
 
 import os
 import io
+import sys
 import re
 import base64
+import json
+import time
+import random
 import difflib
-import tempfile
-from typing import List, Tuple, Optional, Iterable
+import functools
+import unicodedata
+import shutil
+import sqlite3
+import hashlib
+import logging
+import multiprocessing
+import threading
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import Any, List, Tuple, Optional, Iterable
 
 import streamlit as st
 import streamlit.components.v1 as components
 from PIL import Image
 from faster_whisper import WhisperModel
+import numpy as np
 
 try:
     from langchain_openai import ChatOpenAI, OpenAIEmbeddings
@@ -34,11 +51,52 @@ try:
 except Exception:
     HAS_OPENAI_SDK = False
 
+try:
+    import httpx
+    HAS_HTTPX = True
+except Exception:
+    HAS_HTTPX = False
+
+try:
+    from langchain_core.embeddings import Embeddings
+except Exception:
+    Embeddings = object
+
+try:
+    from langchain_core.retrievers import BaseRetriever
+except Exception:
+    BaseRetriever = object
+
+try:
+    from langchain_community.docstore.base import Docstore
+except Exception:
+    Docstore = object
+
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except Exception:
+    HAS_TIKTOKEN = False
+
+try:
+    import mmh3
+    HAS_MMH3 = True
+except Exception:
+    HAS_MMH3 = False
+
+try:
+    import faiss
+    HAS_FAISS = True
+except Exception:
+    HAS_FAISS = False
+
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv(), override=False)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 
+logger = logging.getLogger(__name__)
+
 
 # 1) 텍스트 유사도
 _STOPWORDS: set[str] = {
@@ -69,80 +127,270 @@ def is_similar(q: str, p: str, jaccard_thr: float = 0.55, ratio_thr: float = 0.7
     return False
 
 # PDF
-class OpenAIEmbeddingsLite:
+# OpenAI 임베딩 요청 한도 (요청당 토큰 / 입력 개수, 입력 1개당 토큰)
+EMBED_MAX_TOKENS_PER_REQUEST = 300_000
+EMBED_MAX_ITEMS_PER_REQUEST = 2048
+EMBED_MAX_TOKENS_PER_INPUT = 8191
+
+@functools.lru_cache(maxsize=None)
+def _token_encoder(model: str = "text-embedding-3-small"):
+    """모델의 tiktoken 인코더. tiktoken이 없거나 BPE 파일을 받을 수 없으면 None."""
+    if not HAS_TIKTOKEN:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            return None
+
+def _prepare_embed_input(text: str, enc=None) -> tuple[str, int]:
+    """(요청에 보낼 텍스트, 토큰 수). 빈 입력은 공백으로, 입력당 한도 초과분은 잘라냅니다."""
+    text = text or " "
+    if enc is None:
+        # tiktoken이 없으면 UTF-8 바이트 수로 보수적으로 추정
+        return text, len(text.encode("utf-8")) // 2 + 1
+    toks = enc.encode_ordinary(text)
+    if len(toks) > EMBED_MAX_TOKENS_PER_INPUT:
+        toks = toks[:EMBED_MAX_TOKENS_PER_INPUT]
+        text = enc.decode(toks)
+    return text, len(toks)
+
+def _token_batches(texts: list[str], max_tokens: int, max_items: int, enc=None) -> list[list[tuple[int, str, int]]]:
+    """(원래 위치, 텍스트, 토큰 수) 배치 목록. 각 배치는 토큰/개수 한도를 넘지 않습니다."""
+    batches, cur, cur_tokens = [], [], 0
+    for i, t in enumerate(texts):
+        t, n = _prepare_embed_input(t, enc)
+        if cur and (cur_tokens + n > max_tokens or len(cur) >= max_items):
+            batches.append(cur); cur, cur_tokens = [], 0
+        cur.append((i, t, n)); cur_tokens += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    if status == 429:
+        return True
+    msg = str(e).lower()
+    return any(k in msg for k in ("429", "rate limit", "rate_limit", "resource_exhausted", "quota"))
+
+# 상태 코드 없이 올라오는 네트워크 오류 (openai / httpx / requests 예외 클래스 이름)
+_TRANSIENT_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "ConnectError", "ConnectTimeout", "ReadTimeout",
+                          "ReadError", "WriteTimeout", "PoolTimeout", "RemoteProtocolError", "ServiceUnavailable"}
+
+def _is_retryable_error(e: Exception) -> bool:
+    """다시 보내면 성공할 수 있는 오류만 True: 429, 408, 5xx, 연결/타임아웃.
+    잘못된 키·요청·컨텍스트 길이 같은 나머지 4xx와 알 수 없는 오류는 바로 올려 보냅니다."""
+    if _is_rate_limit_error(e):
+        return True
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status == 408 or status >= 500
+    return isinstance(e, (ConnectionError, TimeoutError)) or type(e).__name__ in _TRANSIENT_ERROR_NAMES
+
+def _retry_after_seconds(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except Exception:
+        return None
+
+class OpenAIEmbeddingsLite(Embeddings):
     """langchain-openai 미설치 환경에서 OpenAI SDK로 임베딩 호출하는 폴백.
     LangChain Embeddings 인터페이스 호환: embed_documents, embed_query
+
+    embed_documents는 tiktoken으로 토큰 수를 세어 요청당 토큰/개수 한도 안에서 청크를 묶어 보내고,
+    실패한 배치만 지수 백오프로 재시도합니다 (429/5xx/연결 오류만, _is_retryable_error). 결과는 항상 입력 순서와 같습니다.
+    retry_rate_limits=False면 429는 재시도하지 않고 바로 올려 보냅니다 (ScheduledEmbeddings가 처리).
+    http_client를 주면 그 httpx.Client의 커넥션 풀을 씁니다 (shared_http_client 참고).
     """
-    def __init__(self, model: str = "text-embedding-3-small", api_key: Optional[str] = None):
+    def __init__(
+        self,
+        model: str = "text-embedding-3-small",
+        api_key: Optional[str] = None,
+        max_batch_tokens: int = EMBED_MAX_TOKENS_PER_REQUEST,
+        max_batch_items: int = EMBED_MAX_ITEMS_PER_REQUEST,
+        max_retries: int = 5,
+        dimensions: Optional[int] = None,
+        http_client=None,
+    ):
         if not HAS_OPENAI_SDK:
             raise RuntimeError("OpenAI SDK가 필요합니다. `pip install openai`.")
         key = api_key or OPENAI_API_KEY or os.environ.get("OPENAI_API_KEY", "")
         if not key:
             raise RuntimeError("OPENAI_API_KEY가 없습니다. .env 또는 환경변수에 설정하세요.")
-        self.client = _OpenAIClient(api_key=key)
+        # 재시도는 배치 단위로 직접 처리
+        self.client = _OpenAIClient(api_key=key, max_retries=0, http_client=http_client)
         self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = max_batch_items
+        self.max_retries = max_retries
+        self.dimensions = dimensions
+        self.retry_rate_limits = True
+        self._enc = _token_encoder(model)
+
+    def _embed_batch(self, inputs: list[str]) -> list[list[float]]:
+        delay = 1.0
+        for attempt in range(self.max_retries + 1):
+            try:
+                extra = {"dimensions": self.dimensions} if self.dimensions else {}
+                r = self.client.embeddings.create(model=self.model, input=inputs, **extra)
+                return [d.embedding for d in sorted(r.data, key=lambda d: d.index)]
+            except Exception as e:
+                if (attempt >= self.max_retries or not _is_retryable_error(e)
+                        or (not self.retry_rate_limits and _is_rate_limit_error(e))):
+                    raise
+                time.sleep(delay + random.random() * 0.5)
+                delay = min(delay * 2, 30.0)
 
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
-        out: list[list[float]] = []
-        for t in texts:
-            r = self.client.embeddings.create(model=self.model, input=t)
-            out.append(r.data[0].embedding)
+        out: list = [None] * len(texts)
+        for batch in _token_batches(texts, self.max_batch_tokens, self.max_batch_items, self._enc):
+            vecs = self._embed_batch([t for _, t, _ in batch])
+            for (i, _, _), v in zip(batch, vecs):
+                out[i] = v
         return out
 
     def embed_query(self, text: str) -> list[float]:
-        r = self.client.embeddings.create(model=self.model, input=text)
-        return r.data[0].embedding
+        return self._embed_batch([_prepare_embed_input(text, self._enc)[0]])[0]
 
+# 임베딩 스케줄러 (백엔드별 분당 요청/토큰 예산 안에서 배치를 동시 실행)
+EMBED_RATE_LIMITS = {
+    "openai": {"rpm": int(os.getenv("OPENAI_EMBED_RPM", "3000")), "tpm": int(os.getenv("OPENAI_EMBED_TPM", "1000000"))},
+    "gemini": {"rpm": int(os.getenv("GEMINI_EMBED_RPM", "1500")), "tpm": int(os.getenv("GEMINI_EMBED_TPM", "1000000"))},
+}
+# 동시 요청 수 상한 / 백엔드별 배치 크기 (Gemini batchEmbedContents는 요청당 100개)
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))
+EMBED_BATCH_LIMITS = {
+    "openai": {"tokens": 60_000, "items": 256},
+    "gemini": {"tokens": 60_000, "items": 100},
+}
 
-def build_vectorstore_from_pdfs(
-    files: List,  # 리스트 유사 객체 리스트
-    embed_backend: str = "openai",
-):
-    """PDF 파일들을 로드해 텍스트를 분할하고, 지정한 임베딩으로 FAISS 인덱스를 생성합니다.
+class _RateLimiter:
+    """분당 요청(rpm)/토큰(tpm) 토큰 버킷 + 429 적응형 백오프 (스레드 안전).
 
-    Args:
-        files: 업로드된 PDF 파일 객체들의 리스트. 각 객체는 .read()를 지원해야 합니다.
-        embed_backend: "openai" | "gemini"
-    Returns:
-        FAISS 벡터스토어 인스턴스
+    429가 오면 백엔드 전체를 잠시 멈추고 허용 동시 실행 수를 절반으로 줄이며,
+    성공이 이어지면 동시 실행 수를 하나씩 되돌리고 대기 시간도 줄입니다.
     """
-    docs = []
-    for f in files:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(f.read())
-            tmp_path = tmp.name
-        try:
-            loader = PyPDFLoader(tmp_path)
-            docs.extend(loader.load())
-        finally:
+    def __init__(self, rpm: int, tpm: int, max_concurrency: int):
+        self.rpm, self.tpm = max(1, rpm), max(1, tpm)
+        self._req, self._tok = float(self.rpm), float(self.tpm)
+        self._last = time.monotonic()
+        self._pause_until = 0.0
+        self._penalty = 1.0
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        elapsed, self._last = now - self._last, now
+        self._req = min(self.rpm, self._req + elapsed * self.rpm / 60.0)
+        self._tok = min(self.tpm, self._tok + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int) -> None:
+        tokens = min(max(1, tokens), self.tpm)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._pause_until and self._in_flight < self.concurrency \
+                        and self._req >= 1 and self._tok >= tokens:
+                    self._req -= 1; self._tok -= tokens; self._in_flight += 1
+                    return
+                wait = max(
+                    self._pause_until - now,
+                    (1 - self._req) * 60.0 / self.rpm,
+                    (tokens - self._tok) * 60.0 / self.tpm,
+                    0.05,
+                )
+                self._cond.wait(timeout=min(wait, 5.0))
+
+    def release(self, outcome: str = "ok", retry_after: Optional[float] = None) -> None:
+        """outcome: "ok"(성공) | "limited"(429) | "error"(그 외 실패, 예산 조정 없음)"""
+        with self._cond:
+            self._in_flight -= 1
+            if outcome == "ok":
+                self._penalty = max(1.0, self._penalty / 2)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            elif outcome == "limited":
+                self._penalty = min(self._penalty * 2, 60.0)
+                self.concurrency = max(1, self.concurrency // 2)
+                pause = retry_after if retry_after is not None else self._penalty + random.random()
+                self._pause_until = max(self._pause_until, time.monotonic() + pause)
+            self._cond.notify_all()
+
+_RATE_LIMITERS: dict = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+def _rate_limiter(backend: str) -> _RateLimiter:
+    """프로세스 전체에서 백엔드별로 하나의 리미터를 공유 (여러 세션이 같은 쿼터를 씀)."""
+    with _RATE_LIMITERS_LOCK:
+        if backend not in _RATE_LIMITERS:
+            lim = EMBED_RATE_LIMITS.get(backend, {"rpm": 600, "tpm": 200_000})
+            _RATE_LIMITERS[backend] = _RateLimiter(lim["rpm"], lim["tpm"], EMBED_CONCURRENCY)
+        return _RATE_LIMITERS[backend]
+
+class ScheduledEmbeddings(Embeddings):
+    """임베딩 객체를 감싸 배치를 스레드 풀에서 동시에 보내는 래퍼.
+
+    배치는 토큰 수 기준으로 나누고, 각 요청 전에 백엔드 리미터에서 요청/토큰 예산을 받습니다.
+    429는 리미터가 백오프를 걸고 같은 배치만 다시 보냅니다.
+    embed_documents(texts, progress=fn)의 fn(완료 청크 수, 전체 청크 수)는 호출한 스레드에서 불립니다.
+    """
+    def __init__(self, inner, backend: str, max_retries: int = 8):
+        self.inner = inner
+        self.backend = backend
+        self.max_retries = max_retries
+        self.limiter = _rate_limiter(backend)
+        self._enc = _token_encoder(getattr(inner, "model", None) or EMBED_MODELS.get(backend, ""))
+        if hasattr(inner, "retry_rate_limits"):
+            inner.retry_rate_limits = False
+
+    def _call(self, fn, tokens: int):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(tokens)
             try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
-
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    splits = splitter.split_documents(docs)
-
-    embed_backend = (embed_backend or "openai").lower()
+                out = fn()
+            except Exception as e:
+                if not _is_rate_limit_error(e):
+                    self.limiter.release("error")
+                    raise
+                self.limiter.release("limited", retry_after=_retry_after_seconds(e))
+                if attempt >= self.max_retries:
+                    raise
+                continue
+            self.limiter.release("ok")
+            return out
+
+    def embed_documents(self, texts: list[str], progress=None) -> list[list[float]]:
+        lim = EMBED_BATCH_LIMITS.get(self.backend, {"tokens": 60_000, "items": 100})
+        batches = _token_batches(texts, lim["tokens"], lim["items"], self._enc)
+        out: list = [None] * len(texts)
+        if not batches:
+            return out
+        done = 0
+        with ThreadPoolExecutor(max_workers=min(self.limiter.max_concurrency, len(batches))) as ex:
+            futures = {
+                ex.submit(self._call, functools.partial(self.inner.embed_documents, [t for _, t, _ in b]),
+                          sum(n for _, _, n in b)): b
+                for b in batches
+            }
+            for fut in as_completed(futures):
+                b = futures[fut]
+                for (i, _, _), v in zip(b, fut.result()):
+                    out[i] = v
+                done += len(b)
+                if progress is not None:
+                    progress(done, len(texts))
+        return out
 
-    if embed_backend == "openai":
-        if HAS_OPENAI:
-            embedding = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY or os.getenv("OPENAI_API_KEY", ""))
-        elif HAS_OPENAI_SDK:
-            embedding = OpenAIEmbeddingsLite(model="text-embedding-3-small")
-        else:
-            raise RuntimeError("OpenAI 임베딩 사용 불가: `openai` 또는 `langchain-openai` 설치 필요")
-    elif embed_backend == "gemini":
-        if not HAS_GEMINI:
-            raise RuntimeError("Gemini 임베딩 사용 불가: `langchain-google-genai` 설치 필요")
-        embedding = GoogleGenerativeAIEmbeddings(
-            model="text-embedding-004",
-            google_api_key=GOOGLE_API_KEY or os.getenv("GOOGLE_API_KEY", ""),
-        )
-    else:
-        raise RuntimeError("지원하는 임베딩 백엔드는 'openai'와 'gemini' 뿐입니다.")
+    def embed_query(self, text: str) -> list[float]:
+        text, n = _prepare_embed_input(text, self._enc)
+        return self._call(functools.partial(self.inner.embed_query, text), n)
 
-    return FAISS.from_documents(splits, embedding)
 
 # 3) DOT 파이프라인 문자열 생성
 
@@ -381,7 +629,9 @@ except Exception:
 try:
     from langchain.text_splitter import RecursiveCharacterTextSplitter
     from langchain_community.vectorstores import FAISS
-    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+    from pypdf import PdfReader
     HAS_VS = True
 except Exception:
     HAS_VS = False
@@ -568,20 +818,40 @@ def generate_with_gemini(prompt: str, model_name: str) -> str:
         except Exception as e:
             return f"__GEN_ERROR__ {e}"
 
-def gather_context(k: int = 6, enabled: bool = True, retriever=None) -> str:
-    """업로드 문서 컨텍스트 모으기. retriever 없으면 세션의 vectorstore를 사용."""
+def gather_context(k: int = 6, enabled: bool = True, retriever=None, category: Optional[str] = None) -> str:
+    """업로드 문서 컨텍스트 모으기. retriever 없으면 세션의 vectorstore를 사용.
+
+    category를 주면 (retriever 없이) 인덱스 버전마다 미리 계산해 둔 그 카테고리의 컨텍스트를 돌려줍니다
+    (category_context 참고).
+    """
     if not enabled:
         return ""
     try:
+        if category is not None and retriever is None:
+            if "vectorstore" not in st.session_state:
+                return ""
+            return category_context(st.session_state.vectorstore, category, k=k)
         if retriever is None:
             if "vectorstore" not in st.session_state:
                 return ""
-            retriever = st.session_state.vectorstore.as_retriever(search_kwargs={"k": k})
+            retriever = category_retriever(st.session_state.vectorstore, None, k=k)
         docs = retriever.get_relevant_documents("핵심 개념 요약")
         return "\n\n".join(d.page_content for d in docs)[:6000]
     except Exception:
         return ""
 
+def gather_contexts(queries: list[str], k: int = 6, enabled: bool = True, category: Optional[str] = None) -> list[str]:
+    """질의(문항)별 컨텍스트를 세션 vectorstore에서 search_many로 한 번에 검색합니다.
+    사용할 수 없으면 질의 수만큼 빈 문자열."""
+    empty = [""] * len(queries)
+    if not enabled or not queries or "vectorstore" not in st.session_state:
+        return empty
+    try:
+        found = search_many(st.session_state.vectorstore, list(queries), k, category)
+        return [_join_context(docs) for docs in found]
+    except Exception:
+        return empty
+
 def extract_questions(s: str, expected_n: int) -> list[str]:
     """서술형 문제 추출(번호 구분/단락 구분/라인 기반)."""
     s = (s or "").strip()
@@ -663,26 +933,2495 @@ def render_eval(judged: str):
     st.markdown(f"**판정: {verdict or '판정 불명'}**")
     st.markdown(f"피드백: {feedback or '(없음)'}")
 
+# PDF 파싱 (프로세스 풀)
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", "0") or 0)  # 0 이하 → CPU 수
+PDF_MIN_PAGES_PER_TASK = 8
+# 전체 페이지 수가 이보다 적으면 프로세스 풀 없이 직렬로 파싱 (워커 시작 비용이 파싱보다 큼)
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+
+def _resolve_workers(workers: Optional[int] = None) -> int:
+    n = PDF_PARSE_WORKERS if workers is None else workers
+    if n <= 0:
+        n = os.cpu_count() or 1
+    return max(1, n)
+
+# 워커 프로세스별로 마지막에 연 PDF (같은 파일의 다음 구간을 받으면 다시 파싱하지 않음)
+_WORKER_PDF: dict = {}
+
+def _open_shared_pdf(shm_name: str, size: int):
+    """공유 메모리에 올라간 PDF 바이트를 PdfReader로 엽니다. 워커 안에서 마지막 파일 하나만 캐시합니다."""
+    reader = _WORKER_PDF.get(shm_name)
+    if reader is None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            data = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+        _WORKER_PDF.clear()
+        reader = _WORKER_PDF[shm_name] = PdfReader(io.BytesIO(data))
+    return reader
+
+# 페이지 텍스트 캐시: 페이지 내용 스트림(+폰트/폼 XObject) 해시 → 추출 텍스트. 워커 프로세스가 직접 읽고 씀
+PAGE_TEXT_CACHE_PATH = os.getenv("PAGE_TEXT_CACHE_PATH", os.path.join(".cache", "pages.sqlite"))  # 빈 값이면 끔
+# 글자를 실제로 그리는 연산자 (Tj, TJ, ', "). BT/ET만 있고 글자가 없는 페이지도 있어 BT로는 판단하지 않음
+_TEXT_OP = re.compile(rb"(?:[)\]>]|\s)(?:Tj|TJ|'|\")(?=\s|$)")
+# pid → (sqlite 연결, 잠금). 포크된 워커가 부모 연결을 물려받아 쓰지 않도록 pid별로 열고,
+# 한 프로세스 안에서는 인제스트 작업 스레드와 Streamlit 스레드가 잠금으로 연결 하나를 나눠 씀
+_PAGE_CACHE_CONN: dict = {}
+
+def _page_cache_conn() -> Optional[tuple]:
+    if not PAGE_TEXT_CACHE_PATH:
+        return None
+    entry = _PAGE_CACHE_CONN.get(os.getpid())
+    if entry is None:
+        try:
+            os.makedirs(os.path.dirname(PAGE_TEXT_CACHE_PATH) or ".", exist_ok=True)
+            conn = sqlite3.connect(PAGE_TEXT_CACHE_PATH, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS page_text (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+            conn.commit()
+        except Exception:
+            logger.warning("페이지 텍스트 캐시를 열 수 없습니다: %s", PAGE_TEXT_CACHE_PATH, exc_info=True)
+            return None
+        if os.getpid() not in _PAGE_CACHE_CONN:
+            _PAGE_CACHE_CONN.clear()
+        entry = _PAGE_CACHE_CONN.setdefault(os.getpid(), (conn, threading.Lock()))
+    return entry
+
+def _pdf_obj_digest(obj, h, memo: dict, depth: int = 0) -> None:
+    """PDF 객체(폰트 사전 등)를 결정적으로 해시에 넣습니다. 글리프 프로그램(/FontDescriptor)은 제외."""
+    ref = getattr(obj, "idnum", None)
+    if ref is not None:
+        if ref in memo:
+            h.update(memo[ref])
+            return
+        sub = hashlib.sha1()
+        _pdf_obj_digest(obj.get_object(), sub, memo, depth + 1)
+        memo[ref] = sub.digest()
+        h.update(memo[ref])
+        return
+    if depth > 8:
+        return
+    if hasattr(obj, "get_data"):
+        h.update(hashlib.sha1(obj.get_data()).digest())
+    if isinstance(obj, dict):
+        for k in sorted(obj):
+            if k != "/FontDescriptor":
+                h.update(str(k).encode())
+                _pdf_obj_digest(obj[k] if not hasattr(obj, "raw_get") else obj.raw_get(k), h, memo, depth + 1)
+    elif isinstance(obj, list):
+        for v in obj:
+            _pdf_obj_digest(v, h, memo, depth + 1)
+    elif not hasattr(obj, "get_data"):
+        h.update(str(obj).encode("utf-8", "replace"))
+
+def _page_fingerprint(page, memo: dict) -> tuple[str, bool]:
+    """(캐시 키, 글자 그리기 연산자 유무). 내용 스트림, 폰트, 폼 XObject가 같으면 키가 같습니다."""
+    h = hashlib.sha1(f"pypdf-{getattr(sys.modules.get('pypdf'), '__version__', '')}".encode())
+    contents = page.get_contents()
+    data = contents.get_data() if contents is not None else b""
+    h.update(data)
+    has_text = bool(_TEXT_OP.search(data))
+    res = page.get("/Resources")
+    res = res.get_object() if res is not None else {}
+    fonts = res.get("/Font")
+    if fonts is not None:
+        _pdf_obj_digest(fonts, h, memo)
+    xobjects = res.get("/XObject")
+    for name, ref in sorted((xobjects.get_object() if xobjects is not None else {}).items()):
+        xo = ref.get_object()
+        if xo.get("/Subtype") == "/Form":
+            form = xo.get_data()
+            h.update(name.encode() + hashlib.sha1(form).digest())
+            has_text = has_text or bool(_TEXT_OP.search(form))
+            form_res = xo.get("/Resources")
+            if form_res is not None and form_res.get_object().get("/Font") is not None:
+                _pdf_obj_digest(form_res.get_object()["/Font"], h, memo)
+    return h.hexdigest(), has_text
+
+def _pages_text(reader, start: int, stop: int) -> tuple[list[tuple[int, str, str]], dict]:
+    """[start, stop) 페이지의 (번호, 라벨, 텍스트)와 집계 {"extracted", "cached", "skipped", "seconds"}.
+
+    텍스트 연산자가 없는 페이지(스캔본/전면 이미지)는 추출하지 않고 건너뛰며 결과에도 넣지 않습니다.
+    추출한 텍스트는 페이지 캐시에 저장해, 다른 파일/다음 인제스트에서 같은 페이지는 다시 추출하지 않습니다.
+    """
+    t0 = time.perf_counter()
+    labels = reader.page_labels
+    counts = {"extracted": 0, "cached": 0, "skipped": 0}
+    memo: dict = {}
+    keyed = []
+    for i in range(start, stop):
+        try:
+            key, has_text = _page_fingerprint(reader.pages[i], memo)
+        except Exception:
+            key, has_text = None, True
+        if not has_text:
+            counts["skipped"] += 1
+            continue
+        keyed.append((i, key))
+    cache = _page_cache_conn()
+    cached: dict = {}
+    keys = [k for _, k in keyed if k]
+    if cache is not None and keys:
+        conn, lock = cache
+        try:
+            q = f"SELECT key, text FROM page_text WHERE key IN ({','.join('?' * len(keys))})"
+            with lock:
+                cached = dict(conn.execute(q, keys).fetchall())
+        except Exception:
+            logger.warning("페이지 텍스트 캐시 조회 실패", exc_info=True)
+            cached = {}
+    rows, new = [], []
+    for i, key in keyed:
+        if key in cached:
+            text = cached[key]
+            counts["cached"] += 1
+        else:
+            text = (reader.pages[i].extract_text() or "").strip()
+            counts["extracted"] += 1
+            if key:
+                new.append((key, text))
+        if text:
+            rows.append((i, labels[i], text))
+    if cache is not None and new:
+        conn, lock = cache
+        try:
+            with lock:
+                conn.executemany("INSERT OR REPLACE INTO page_text (key, text) VALUES (?, ?)", new)
+                conn.commit()
+        except Exception:
+            logger.warning("페이지 텍스트 캐시 기록 실패", exc_info=True)
+    counts["seconds"] = time.perf_counter() - t0
+    return rows, counts
+
+def _extract_page_range(task: tuple) -> tuple[list[tuple[int, str, str]], dict]:
+    """(공유 메모리 이름, 크기, 시작, 끝) 범위에 대한 _pages_text 결과. 프로세스 풀 워커에서 실행됩니다."""
+    shm_name, size, start, stop = task
+    return _pages_text(_open_shared_pdf(shm_name, size), start, stop)
+
+def _read_uploads(files: List) -> list[tuple[str, bytes]]:
+    """업로드 파일 객체들 → (파일명, 바이트) 리스트."""
+    out = []
+    for i, f in enumerate(files):
+        data = f.getvalue() if hasattr(f, "getvalue") else f.read()
+        out.append((getattr(f, "name", None) or f"file_{i}.pdf", data))
+    return out
+
+def _ordered_pool_map(fn, args: list, n_workers: int, in_flight: int):
+    """args 순서대로 fn 결과를 내보내되, 프로세스 풀에 동시에 올려 두는 작업은 in_flight개로 제한합니다."""
+    if n_workers <= 1 or len(args) <= 1:
+        for a in args:
+            yield fn(a)
+        return
+    # 멀티스레드(Streamlit 서버, 인제스트 작업 스레드)에서 fork하면 다른 스레드가 잡고 있던 잠금을 물려받아
+    # 워커가 멈출 수 있으므로 forkserver(없으면 spawn)로 워커를 띄움
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    ex = ProcessPoolExecutor(max_workers=min(n_workers, len(args)), mp_context=ctx)
+    try:
+        pending = deque(ex.submit(fn, a) for a in args[:in_flight])
+        nxt = len(pending)
+        while pending:
+            res = pending.popleft().result()
+            if nxt < len(args):
+                pending.append(ex.submit(fn, args[nxt])); nxt += 1
+            yield res
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+
+def _iter_pdf_pages(payloads: list[tuple[str, bytes]], workers: Optional[int] = None,
+                    file_stats: Optional[dict] = None):
+    """(파일 순번, 페이지 Document)를 (업로드 순서, 페이지 순서)대로 흘려보냅니다.
+
+    각 파일의 마지막에는 (파일 순번, None)을 내보내 파일 경계를 알립니다.
+    텍스트가 없는 페이지는 내보내지 않습니다 (_pages_text 참고).
+    file_stats가 주어지면 파일이 끝날 때마다 file_stats[파일명]에
+    {"pages", "extracted", "cached", "skipped", "seconds"}를 기록합니다 (seconds는 워커들의 추출 시간 합).
+    업로드 바이트를 임시 파일 없이 메모리(BytesIO / 공유 메모리)에서 바로 파싱합니다.
+    파싱은 프로세스 풀에서 미리 돌리되, 결과를 기다리는 작업 수는 워커당 2개로 제한합니다.
+    전체 페이지가 PDF_PARALLEL_MIN_PAGES보다 적으면 풀을 띄우지 않고 직렬로 파싱합니다.
+    """
+    n_workers = _resolve_workers(workers)
+    readers = [PdfReader(io.BytesIO(data)) for _, data in payloads]
+    page_counts = [len(r.pages) for r in readers]
+    # 워커당 4개 정도의 작업이 돌아가도록 페이지 구간 크기를 정함
+    per_task = max(PDF_MIN_PAGES_PER_TASK, -(-sum(page_counts) // (n_workers * 4)))
+    tasks = [
+        (i, start, min(start + per_task, n))
+        for i, n in enumerate(page_counts)
+        for start in range(0, n, per_task)
+    ]
+    shms, results = [], None
+    try:
+        if n_workers <= 1 or len(tasks) <= 1 or sum(page_counts) < PDF_PARALLEL_MIN_PAGES:
+            results = (_pages_text(readers[i], start, stop) for i, start, stop in tasks)
+        else:
+            # 업로드 바이트는 파일당 한 번만 공유 메모리에 복사하고, 작업에는 이름만 넘김 (디스크 I/O 없음)
+            for _, data in payloads:
+                shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+                shm.buf[:len(data)] = data
+                shms.append(shm)
+            results = _ordered_pool_map(
+                _extract_page_range,
+                [(shms[i].name, len(payloads[i][1]), start, stop) for i, start, stop in tasks],
+                n_workers, n_workers * 2,
+            )
+        task_pos = 0
+        for i, n in enumerate(page_counts):
+            agg = {"pages": n, "extracted": 0, "cached": 0, "skipped": 0, "seconds": 0.0}
+            while task_pos < len(tasks) and tasks[task_pos][0] == i:
+                rows, counts = next(results)
+                for k, v in counts.items():
+                    agg[k] += v
+                for page_no, label, text in rows:
+                    yield i, Document(
+                        page_content=text,
+                        metadata={"source": payloads[i][0], "page": page_no, "page_label": label, "total_pages": n},
+                    )
+                task_pos += 1
+            if file_stats is not None:
+                file_stats[payloads[i][0]] = agg
+            yield i, None
+    finally:
+        if results is not None:
+            results.close()
+        for shm in shms:
+            shm.close()
+            try: shm.unlink()
+            except FileNotFoundError: pass
+
+def load_pdf_documents(files: List, workers: Optional[int] = None) -> list:
+    """업로드 PDF들을 페이지 단위 Document로 로드합니다.
+
+    파일과 (큰 파일은) 페이지 구간을 작업 단위로 나눠 프로세스 풀에서 병렬로 파싱하고,
+    결과는 항상 (업로드 순서, 페이지 순서)대로 모읍니다. 텍스트가 없는 페이지는 빠집니다.
+    metadata: source=업로드 파일명, page=0부터 시작하는 페이지 번호
+
+    Args:
+        files: .read()를 지원하는 업로드 파일 객체 리스트
+        workers: 워커 프로세스 수. None이면 PDF_PARSE_WORKERS, 0 이하면 CPU 수, 1이면 직렬 파싱
+    """
+    return [d for _, d in _iter_pdf_pages(_read_uploads(files), workers=workers) if d is not None]
+
+# 청크 임베딩 캐시 (세션/코퍼스 공유, SQLite)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join(".cache", "embeddings.sqlite"))
+EMBED_CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "1024"))
+# 질의 임베딩이 문서 임베딩과 다른 백엔드 (task_type 구분)
+_QUERY_DISTINCT_BACKENDS = {"gemini"}
+
+class EmbeddingCache:
+    """(백엔드, 모델, 정규화 텍스트 해시) → float32 벡터를 저장하는 SQLite 캐시.
+
+    조회 때마다 last_used를 갱신하고, 총 용량이 max_bytes를 넘으면 오래 안 쓴 항목부터 지웁니다(LRU).
+    hits/misses 카운터는 프로세스 내 누적값입니다.
+    """
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_bytes: int = EMBED_CACHE_MAX_MB * 1024 * 1024):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb (key TEXT PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS emb_last_used ON emb(last_used)")
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM emb").fetchone()
+        self._bytes = int(row[0])
+
+    @staticmethod
+    def make_key(backend: str, model: str, text: str) -> str:
+        norm = " ".join(unicodedata.normalize("NFC", text or "").split())
+        return hashlib.sha1(f"{backend}\x00{model}\x00{norm}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> list:
+        found: dict = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                q = f"SELECT key, vec FROM emb WHERE key IN ({','.join('?' * len(part))})"
+                found.update(self._conn.execute(q, part).fetchall())
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE emb SET last_used=? WHERE key=?", [(now, k) for k in found])
+                self._conn.commit()
+            self.hits += sum(1 for k in keys if k in found)
+            self.misses += sum(1 for k in keys if k not in found)
+        return [np.frombuffer(found[k], dtype=np.float32).tolist() if k in found else None for k in keys]
+
+    def put_many(self, keys: list[str], vectors: list) -> None:
+        now = time.time()
+        # 같은 키가 여러 번 있으면 마지막 벡터만
+        rows = list({k: (k, np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in zip(keys, vectors)}.values())
+        with self._lock:
+            # INSERT OR REPLACE로 덮어쓰는 행의 크기는 빼 줌 (안 빼면 용량 추정이 부풀어 너무 일찍 비움)
+            replaced = 0
+            for i in range(0, len(rows), 500):
+                part = [r[0] for r in rows[i:i + 500]]
+                q = f"SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM emb WHERE key IN ({','.join('?' * len(part))})"
+                replaced += int(self._conn.execute(q, part).fetchone()[0])
+            self._conn.executemany("INSERT OR REPLACE INTO emb (key, vec, last_used) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+            self._bytes += sum(len(r[1]) for r in rows) - replaced
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # 상한의 90%까지 오래된 항목부터 삭제
+        target = int(self.max_bytes * 0.9)
+        while self._bytes > target:
+            rows = self._conn.execute("SELECT key, LENGTH(vec) FROM emb ORDER BY last_used LIMIT 1000").fetchall()
+            if not rows:
+                self._bytes = 0
+                break
+            victims = []
+            for k, n in rows:
+                if self._bytes <= target:
+                    break
+                victims.append((k,)); self._bytes -= n
+            self._conn.executemany("DELETE FROM emb WHERE key=?", victims)
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            n = self._conn.execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / total) if total else 0.0,
+                "entries": n, "bytes": self._bytes}
+
+_EMBED_CACHE: Optional[EmbeddingCache] = None
+_EMBED_CACHE_LOCK = threading.Lock()
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """프로세스 공용 임베딩 캐시. 열 수 없으면 None (캐시 없이 동작)."""
+    global _EMBED_CACHE
+    with _EMBED_CACHE_LOCK:
+        if _EMBED_CACHE is None:
+            try:
+                _EMBED_CACHE = EmbeddingCache()
+            except Exception:
+                return None
+        return _EMBED_CACHE
+
+def embedding_cache_stats() -> dict:
+    cache = get_embedding_cache()
+    return cache.stats() if cache is not None else {}
+
+# 질의 임베딩 LRU/TTL 캐시 (프로세스 메모리). 같은 질의는 SQLite 조회나 API 왕복 없이 바로 돌려줌
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))  # 0이면 끔
+QUERY_CACHE_TTL_SEC = float(os.getenv("QUERY_CACHE_TTL_SEC", "3600"))
+
+class QueryEmbeddingLRU:
+    """EmbeddingCache.make_key(백엔드, 질의 모델, 정규화 텍스트) → 벡터를 최근 사용 순으로 maxsize개까지 보관.
+
+    ttl초가 지난 항목은 조회 때 버립니다. hits/misses/expired는 프로세스 내 누적값입니다.
+    """
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL_SEC):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._items: OrderedDict = OrderedDict()  # key → (저장 시각, float32 벡터)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.ttl > 0 and time.monotonic() - item[0] > self.ttl:
+                del self._items[key]
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+        return item[1].tolist()
+
+    def put(self, key: str, vector) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic(), np.asarray(vector, dtype=np.float32))
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "expired": self.expired,
+                    "hit_rate": (self.hits / total) if total else 0.0, "entries": len(self._items)}
+
+_QUERY_CACHE = QueryEmbeddingLRU()
+
+def query_cache_stats() -> dict:
+    return _QUERY_CACHE.stats()
+
+class CachedEmbeddings(Embeddings):
+    """API 호출 전에 EmbeddingCache를 확인하는 임베딩 래퍼. 미스만 inner로 보내고 결과를 저장합니다.
+
+    embed_query는 그보다 먼저 프로세스 메모리의 질의 LRU(QueryEmbeddingLRU)를 확인합니다.
+    """
+    def __init__(self, inner, backend: str, model: str, cache: Optional[EmbeddingCache] = None,
+                 query_cache: Optional[QueryEmbeddingLRU] = None):
+        self.inner = inner
+        self.backend = backend
+        self.model = model
+        self.cache = cache if cache is not None else get_embedding_cache()
+        self.query_cache = query_cache if query_cache is not None else _QUERY_CACHE
+
+    def _query_model(self) -> str:
+        return f"{self.model}#query" if self.backend in _QUERY_DISTINCT_BACKENDS else self.model
+
+    def embed_documents(self, texts: list[str], progress=None) -> list[list[float]]:
+        if self.cache is None:
+            return _embed_texts(self.inner, texts, progress)
+        keys = [EmbeddingCache.make_key(self.backend, self.model, t) for t in texts]
+        out = self.cache.get_many(keys)
+        miss = [i for i, v in enumerate(out) if v is None]
+        n_hit = len(texts) - len(miss)
+        if progress is not None and n_hit:
+            progress(n_hit, len(texts))
+        if miss:
+            vecs = _embed_texts(
+                self.inner, [texts[i] for i in miss],
+                (lambda done, _total: progress(n_hit + done, len(texts))) if progress is not None else None,
+            )
+            self.cache.put_many([keys[i] for i in miss], vecs)
+            for i, v in zip(miss, vecs):
+                out[i] = v
+        return out
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """여러 질의를 임베딩합니다. 질의 LRU → SQLite 캐시 순으로 확인하고, 남은 미스만 한 번의 배치로 보냅니다.
+        질의/문서 임베딩이 다른 백엔드(_QUERY_DISTINCT_BACKENDS)는 미스를 embed_query로 하나씩 보냅니다."""
+        keys = [EmbeddingCache.make_key(self.backend, self._query_model(), t) for t in texts]
+        out = [self.query_cache.get(key) for key in keys]
+        miss = [i for i, v in enumerate(out) if v is None]
+        if miss and self.cache is not None:
+            for i, v in zip(miss, self.cache.get_many([keys[i] for i in miss])):
+                out[i] = v
+        # 같은 질의가 여러 번 있으면 한 번만 임베딩
+        todo = list({keys[i]: i for i in miss if out[i] is None}.values())
+        if todo:
+            if self.backend in _QUERY_DISTINCT_BACKENDS:
+                vecs = [self.inner.embed_query(texts[i]) for i in todo]
+            else:
+                vecs = _embed_texts(self.inner, [texts[i] for i in todo])
+            if self.cache is not None:
+                self.cache.put_many([keys[i] for i in todo], vecs)
+            fresh = {keys[i]: v for i, v in zip(todo, vecs)}
+            for i in miss:
+                if out[i] is None:
+                    out[i] = fresh[keys[i]]
+        for i in miss:
+            self.query_cache.put(keys[i], out[i])
+        return out
+
+    def embed_query(self, text: str) -> list[float]:
+        key = EmbeddingCache.make_key(self.backend, self._query_model(), text)
+        hit = self.query_cache.get(key)
+        if hit is not None:
+            return hit
+        hit = self.cache.get_many([key])[0] if self.cache is not None else None
+        if hit is None:
+            hit = self.inner.embed_query(text)
+            if self.cache is not None:
+                self.cache.put_many([key], [hit])
+        self.query_cache.put(key, hit)
+        return hit
+
+# 로컬 해싱 임베딩: 네트워크/키 없이 문자 n-gram을 고정 차원에 해싱 (비용 없는 검색 모드, 테스트/벤치마크용)
+LOCAL_EMBED_DIM = int(os.getenv("LOCAL_EMBED_DIM", "1024"))
+_LOCAL_NONWORD = re.compile(r"[^0-9a-z가-힣]+")
+_TABULATION: dict = {}  # (seed, 최대 n) → 위치별 코드포인트 난수표
+_TABULATION_LOCK = threading.Lock()
+
+def _tabulation_tables(seed: int, n: int) -> np.ndarray:
+    """n-gram 위치 j마다 BMP 코드포인트 → 64비트 난수 표 (mmh3로 생성, 프로세스당 한 번)."""
+    with _TABULATION_LOCK:
+        tables = _TABULATION.get((seed, n))
+        if tables is None:
+            tables = np.empty((n, 0x10000), dtype=np.uint64)
+            for j in range(n):
+                tables[j] = [mmh3.hash64(cp.to_bytes(4, "little"), seed + j, signed=False)[0] for cp in range(0x10000)]
+            _TABULATION[(seed, n)] = tables
+        return tables
+
+class HashingEmbeddings(Embeddings):
+    """문자 n-gram 해싱 임베딩 (결정적, 상태 없음).
+
+    텍스트를 NFKC/소문자로 정규화하고 기호를 공백 하나로 바꾼 뒤, ngram_range 길이의 문자 n-gram을
+    dim개 버킷에 해싱합니다. n-gram 해시는 mmh3로 만든 위치별 난수표를 XOR하는 tabulation hashing이라
+    배치 전체를 NumPy에서 한 번에 계산합니다. 해시 최상위 비트로 ±를 정해 충돌이 서로 상쇄되게 하고,
+    버킷 값에 sublinear TF(sign · log(1 + |x|))를 적용한 뒤 L2 정규화합니다. 긴 n-gram일수록 드물어
+    정보량이 크므로 IDF 대신 길이별 가중치를 곱합니다. 코퍼스 통계를 두지 않으므로
+    같은 텍스트는 언제 어디서나 같은 벡터가 됩니다.
+    """
+    def __init__(self, dim: int = LOCAL_EMBED_DIM, ngram_range: Tuple[int, int] = (2, 4), seed: int = 0x5EED):
+        if not HAS_MMH3:
+            raise RuntimeError("로컬 임베딩 사용 불가: `mmh3` 설치 필요")
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.seed = seed
+        self.model = f"hash-ngram{ngram_range[0]}{ngram_range[1]}-{dim}"
+        self._tables = _tabulation_tables(seed, ngram_range[1])
+
+    def _vectors(self, texts: list[str]) -> np.ndarray:
+        """texts 전체를 이어 붙여 n-gram 해시와 버킷 합산을 한 번의 NumPy 연산으로 처리합니다."""
+        norm = [_LOCAL_NONWORD.sub(" ", unicodedata.normalize("NFKC", t or "").lower()).strip() for t in texts]
+        cps = np.frombuffer("".join(f" {t} " for t in norm if t).encode("utf-32-le"), dtype=np.uint32)
+        cps = np.where(cps < 0x10000, cps, 0xFFFD)
+        doc = np.repeat(np.arange(len(norm), dtype=np.int64), [len(t) + 2 if t else 0 for t in norm])
+        acc = np.zeros(len(norm) * self.dim, dtype=np.float64)
+        lo, hi = self.ngram_range
+        for n in range(lo, hi + 1):
+            m = len(cps) - n + 1
+            if m <= 0:
+                break
+            h = np.full(m, np.uint64(n), dtype=np.uint64)
+            for j in range(n):
+                h ^= self._tables[j][cps[j:j + m]]
+            inside = doc[:m] == doc[n - 1:n - 1 + m]  # 문서 경계를 넘는 n-gram 제외
+            h, rows = h[inside], doc[:m][inside]
+            sign = 1.0 - 2.0 * (h >> np.uint64(63)).astype(np.float64)
+            cols = (h % np.uint64(self.dim)).astype(np.int64)
+            acc += np.bincount(rows * self.dim + cols, weights=sign * (1.0 + 0.5 * (n - lo)), minlength=acc.size)
+        out = acc.reshape(len(norm), self.dim)
+        out = np.sign(out) * np.log1p(np.abs(out))
+        lens = np.linalg.norm(out, axis=1, keepdims=True)
+        return (out / np.where(lens > 0, lens, 1.0)).astype(np.float32)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._vectors(list(texts)).tolist() if texts else []
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._vectors([text])[0].tolist()
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_documents(texts)
+
+# 임베딩 백엔드
+EMBED_MODELS = {"openai": "text-embedding-3-small", "gemini": "text-embedding-004",
+                "local": f"hash-ngram24-{LOCAL_EMBED_DIM}"}
+
+# text-embedding-3 계열의 축소 차원 (0이면 모델 기본 1536). 앞쪽 성분만 남기고 다시 정규화한 벡터를 돌려받음
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0"))
+
+# 백엔드별 임베딩 객체/HTTP 클라이언트는 프로세스당 하나 (get_embedding, shared_http_client)
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "120"))
+_EMBEDDINGS: dict = {}  # (백엔드, 모델 식별자) → 임베딩 객체
+_HTTP_CLIENT = None
+_EMBEDDINGS_LOCK = threading.RLock()
+
+def get_embedding(embed_backend: str = "openai"):
+    """백엔드 이름으로 LangChain 호환 임베딩 객체를 만듭니다. ("openai" | "gemini" | "local")
+
+    먼저 청크 임베딩 캐시(CachedEmbeddings)를 확인하고, 미스만 ScheduledEmbeddings로
+    백엔드별 분당 예산 안에서 동시 실행합니다.
+    "local"은 캐시 조회보다 직접 계산이 빠르므로 HashingEmbeddings를 그대로 돌려줍니다.
+    객체는 (백엔드, 모델 식별자)마다 프로세스에서 한 번만 만들어 모든 호출·세션이 공유하므로
+    API 클라이언트와 커넥션 풀(keep-alive)도 재사용됩니다. 생성에 실패하면 캐시하지 않습니다.
+    """
+    b = (embed_backend or "openai").lower()
+    key = (b, embed_model_id(b))
+    with _EMBEDDINGS_LOCK:
+        emb = _EMBEDDINGS.get(key)
+        if emb is None:
+            if b == "local":
+                emb = _make_base_embedding(b)
+            else:
+                emb = CachedEmbeddings(ScheduledEmbeddings(_make_base_embedding(b), b), b, embed_model_id(b))
+            _EMBEDDINGS[key] = emb
+        return emb
+
+def embedding_registry_stats() -> dict:
+    """공유 중인 임베딩 객체 목록과 HTTP 커넥션 풀 사용 여부."""
+    with _EMBEDDINGS_LOCK:
+        backends = sorted(f"{b}:{m}" for b, m in _EMBEDDINGS)
+    return {"embeddings": backends, "http_pool": _HTTP_CLIENT is not None}
+
+def embed_model_id(b: str) -> str:
+    """캐시 키에 쓰는 모델 식별자. 축소 차원을 요청하면 "모델@차원d"."""
+    model = EMBED_MODELS.get(b, "")
+    return f"{model}@{EMBED_DIMENSIONS}d" if b == "openai" and EMBED_DIMENSIONS else model
+
+def shared_http_client():
+    """OpenAI 호출용 프로세스 공용 httpx.Client (keep-alive 커넥션 풀). httpx가 없으면 None (SDK 기본값 사용).
+
+    풀 크기는 임베딩 동시 요청 수(EMBED_CONCURRENCY)에 맞춰, 동시 배치가 서로 연결을 기다리거나
+    매번 새 TCP/TLS 연결을 맺지 않게 합니다.
+    """
+    global _HTTP_CLIENT
+    if not HAS_HTTPX:
+        return None
+    with _EMBEDDINGS_LOCK:
+        if _HTTP_CLIENT is None:
+            _HTTP_CLIENT = httpx.Client(
+                limits=httpx.Limits(max_connections=EMBED_CONCURRENCY * 2,
+                                    max_keepalive_connections=EMBED_CONCURRENCY,
+                                    keepalive_expiry=HTTP_KEEPALIVE_SEC),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+            )
+        return _HTTP_CLIENT
+
+def _make_base_embedding(b: str):
+    if b == "openai":
+        # SDK 직접 호출 래퍼 우선 (토큰 기준 배치 + 배치 단위 재시도)
+        if HAS_OPENAI_SDK:
+            return OpenAIEmbeddingsLite(model=EMBED_MODELS["openai"], dimensions=EMBED_DIMENSIONS or None,
+                                        http_client=shared_http_client())
+        if HAS_OPENAI:
+            return OpenAIEmbeddings(
+                model=EMBED_MODELS["openai"],
+                openai_api_key=OPENAI_API_KEY or os.getenv("OPENAI_API_KEY", ""),
+                dimensions=EMBED_DIMENSIONS or None,
+                http_client=shared_http_client(),
+            )
+        raise RuntimeError("OpenAI 임베딩 사용 불가: `openai` 또는 `langchain-openai` 설치 필요")
+    if b == "gemini":
+        if not HAS_GEMINI:
+            raise RuntimeError("Gemini 임베딩 사용 불가: `langchain-google-genai` 설치 필요")
+        return GoogleGenerativeAIEmbeddings(
+            model=EMBED_MODELS["gemini"],
+            google_api_key=GOOGLE_API_KEY or os.getenv("GOOGLE_API_KEY", ""),
+        )
+    if b == "local":
+        return HashingEmbeddings()
+    raise RuntimeError("지원하는 임베딩 백엔드는 'openai', 'gemini', 'local' 뿐입니다.")
+
+# 청크 분할: 문자 수 기준(char, 기본) 또는 토큰 수 기준(token)
+CHUNK_MODE = os.getenv("CHUNK_MODE", "char").strip().lower()
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_TOKEN_OVERLAP = int(os.getenv("CHUNK_TOKEN_OVERLAP", "40"))
+
+# 문장 경계: 문장부호 뒤 공백 또는 빈 줄(문단). PDF 추출의 줄바꿈 하나는 레이아웃 줄넘김이므로 공백으로 취급
+_SENTENCE_END = re.compile(r"(?<=[.!?。？！])\s+|\n\s*\n\s*")
+_LINE_WRAP = re.compile(r"\s*\n\s*")
+
+class TokenSentenceSplitter:
+    """토큰 수 기준으로 청크를 만들되, 청크 경계를 문장 경계에 맞추는 분할기.
+
+    문장을 chunk_size 토큰까지 차례로 채우고, 다음 청크는 직전 청크 끝의 문장들 중
+    chunk_overlap 토큰 이내만 겹쳐서 시작합니다. 한 문장이 chunk_size를 넘으면 그 문장만 잘라 냅니다.
+    토큰 수는 임베딩 모델의 tiktoken 인코더로 세고, 인코더가 없으면 UTF-8 바이트 수로 추정합니다.
+    RecursiveCharacterTextSplitter처럼 split_documents(docs)를 제공합니다.
+    """
+    def __init__(self, chunk_size: int = CHUNK_TOKENS, chunk_overlap: int = CHUNK_TOKEN_OVERLAP,
+                 model: str = "text-embedding-3-small"):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap은 chunk_size보다 작아야 합니다.")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._enc = _token_encoder(model)
+
+    def count_tokens(self, text: str) -> int:
+        # 입력당 한도로 자르지 않은 실제 토큰 수 (_prepare_embed_input은 EMBED_MAX_TOKENS_PER_INPUT에서 멈춤)
+        if not text:
+            return 0
+        if self._enc is None:
+            return len(text.encode("utf-8")) // 2 + 1
+        return len(self._enc.encode_ordinary(text))
+
+    def _split_long(self, sent: str, n: int) -> list[tuple[str, int]]:
+        # 너무 긴 문장은 토큰 비율로 글자 구간을 잡아 공백 근처에서 자르고, 그래도 넘는 조각은 다시 자름
+        out = []
+        step = max(1, len(sent) * self.chunk_size // n)
+        i = 0
+        while i < len(sent):
+            j = min(len(sent), i + step)
+            if j < len(sent):
+                k = sent.rfind(" ", i + step // 2, j)
+                j = k if k > i else j
+            piece = sent[i:j].strip()
+            i = j
+            if not piece:
+                continue
+            m = self.count_tokens(piece)
+            if m > self.chunk_size and 1 < len(piece) < len(sent):
+                out.extend(self._split_long(piece, m))
+            else:
+                out.append((piece, m))
+        return out
+
+    def _sentences(self, text: str) -> list[tuple[str, int]]:
+        out, pos = [], 0
+        for m in list(_SENTENCE_END.finditer(text)) + [None]:
+            end = m.start() if m else len(text)
+            sent = _LINE_WRAP.sub(" ", text[pos:end]).strip()
+            if m:
+                pos = m.end()
+            if not sent:
+                continue
+            n = self.count_tokens(sent)
+            out.extend([(sent, n)] if n <= self.chunk_size else self._split_long(sent, n))
+        return out
+
+    def split_text(self, text: str) -> list[str]:
+        chunks, cur, cur_tokens = [], [], 0
+        for sent, n in self._sentences(text or ""):
+            if cur and cur_tokens + n > self.chunk_size:
+                chunks.append(" ".join(s for s, _ in cur))
+                # 겹침: 직전 청크 끝에서 chunk_overlap 토큰 이내의 문장만 이어받음
+                keep, keep_tokens = [], 0
+                for s, k in reversed(cur):
+                    if keep_tokens + k > self.chunk_overlap or keep_tokens + k + n > self.chunk_size:
+                        break
+                    keep.insert(0, (s, k)); keep_tokens += k
+                cur, cur_tokens = keep, keep_tokens
+            cur.append((sent, n)); cur_tokens += n
+        if cur:
+            chunks.append(" ".join(s for s, _ in cur))
+        return chunks
+
+    def split_documents(self, docs: list) -> list:
+        return [
+            Document(page_content=chunk, metadata=dict(doc.metadata))
+            for doc in docs for chunk in self.split_text(doc.page_content)
+        ]
+
+def _make_splitter(settings: Optional[dict] = None):
+    """SPLITTER_SETTINGS 형식의 설정으로 분할기를 만듭니다."""
+    cfg = dict(settings or SPLITTER_SETTINGS)
+    if cfg.pop("mode", "char") == "token":
+        return TokenSentenceSplitter(**cfg)
+    return RecursiveCharacterTextSplitter(**cfg)
+
+def chunking_report(files: List, settings_list: Optional[list] = None, workers: Optional[int] = None) -> list[dict]:
+    """분할 설정별 청크 수와 임베딩될 총 토큰 수를 비교합니다 (임베딩 API는 호출하지 않음).
+
+    overlap_ratio는 (청크 토큰 합 / 원문 토큰 합 - 1), 즉 겹침 때문에 추가로 임베딩되는 비율입니다.
+    """
+    settings_list = settings_list or [
+        {"chunk_size": 1000, "chunk_overlap": 200},
+        {"mode": "token", "chunk_size": CHUNK_TOKENS, "chunk_overlap": CHUNK_TOKEN_OVERLAP},
+        {"mode": "token", "chunk_size": CHUNK_TOKENS, "chunk_overlap": 0},
+    ]
+    pages = load_pdf_documents(files, workers=workers)
+    enc = _token_encoder()
+    source_tokens = sum(_prepare_embed_input(p.page_content, enc)[1] for p in pages if p.page_content)
+    report = []
+    for cfg in settings_list:
+        chunks = _make_splitter(cfg).split_documents(pages)
+        tokens = sum(_prepare_embed_input(c.page_content, enc)[1] for c in chunks)
+        report.append({
+            "settings": cfg, "chunks": len(chunks), "tokens": tokens, "source_tokens": source_tokens,
+            "overlap_ratio": tokens / source_tokens - 1 if source_tokens else 0.0,
+        })
+    return report
+
+# 인제스트 캐시 (PDF 바이트 해시 + 분할 설정 + 임베딩 모델 → 페이지/청크/벡터)
+INGEST_CACHE_DIR = os.getenv("INGEST_CACHE_DIR", os.path.join(".cache", "ingest"))
+# 분할 설정은 캐시 키에 포함되므로, 모드/크기를 바꾸면 해당 설정으로 다시 인제스트됩니다
+SPLITTER_SETTINGS = (
+    {"mode": "token", "chunk_size": CHUNK_TOKENS, "chunk_overlap": CHUNK_TOKEN_OVERLAP}
+    if CHUNK_MODE == "token" else {"chunk_size": 1000, "chunk_overlap": 200}
+)
+
+# 문장 분할 규칙을 바꾸면 올림 (token 모드 캐시 키에만 들어가 이전 규칙으로 만든 청크를 다시 쓰지 않음)
+_SENTENCE_RULES_VERSION = 2
+
+def _ingest_cache_key(data: bytes, embed_backend: str) -> str:
+    b = (embed_backend or "openai").lower()
+    splitter = dict(SPLITTER_SETTINGS)
+    if splitter.get("mode") == "token":
+        splitter["sentence_rules"] = _SENTENCE_RULES_VERSION
+    cfg = json.dumps({"splitter": splitter, "backend": b, "model": embed_model_id(b)}, sort_keys=True)
+    return hashlib.sha256(hashlib.sha256(data).digest() + cfg.encode("utf-8")).hexdigest()
+
+def _load_ingest_cache(key: str) -> Optional[dict]:
+    """캐시 적중 시 {"pages", "chunks", "vectors"} 반환, 없거나 손상되면 None."""
+    base = os.path.join(INGEST_CACHE_DIR, key)
+    try:
+        with open(base + ".json", encoding="utf-8") as f:
+            entry = json.load(f)
+        entry["vectors"] = np.load(base + ".npy")
+    except Exception:
+        return None
+    if len(entry["vectors"]) != len(entry["chunks"]):
+        return None
+    return entry
+
+def _save_ingest_cache(key: str, pages: list, chunks: list, vectors) -> None:
+    base = os.path.join(INGEST_CACHE_DIR, key)
+    try:
+        os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+        # 임베딩하지 않은(중복 제거된) 청크의 벡터는 None → NaN 행
+        dim = next((len(v) for v in vectors if v is not None), 0)
+        arr = np.full((len(vectors), dim), np.nan, dtype=np.float32)
+        for n, v in enumerate(vectors):
+            if v is not None:
+                arr[n] = v
+        # 쓰기 도중 중단돼도 반쪽짜리 항목이 남지 않도록 임시 파일 → 교체
+        np.save(base + ".tmp.npy", arr)
+        with open(base + ".tmp.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "pages": [{"text": d.page_content, "metadata": d.metadata} for d in pages],
+                "chunks": [{"text": d.page_content, "metadata": d.metadata} for d in chunks],
+            }, f, ensure_ascii=False)
+        os.replace(base + ".tmp.npy", base + ".npy")
+        os.replace(base + ".tmp.json", base + ".json")
+    except Exception:
+        pass
+
+# 인덱스 영속화 (코퍼스 지문 → 로컬 디렉터리)
+VECTORSTORE_DIR = os.getenv("VECTORSTORE_DIR", os.path.join(".cache", "faiss"))
+# 저장된 인덱스를 읽기 전용 mmap으로 열기 (같은 호스트의 여러 프로세스가 페이지 캐시를 공유)
+VECTORSTORE_MMAP = os.getenv("VECTORSTORE_MMAP", "1") != "0"
+
+class MmapDocstore(Docstore):
+    """mmap으로 여는 읽기 전용 도크스토어.
+
+    docs.bin: 위치 순서대로 이어 붙인 청크 JSON({"text", "metadata"}, UTF-8)
+    docs_offsets.npy: 청크 i의 바이트 구간 [offsets[i], offsets[i+1])
+    docs_ids.npy: 청크 i의 docstore id (고정 폭 바이트열)
+    열 때는 파일을 읽지 않고, 검색 결과로 필요한 청크만 그때그때 디코딩합니다.
+    id → 위치 맵은 id로 처음 조회할 때 만듭니다.
+    """
+    def __init__(self, path: str):
+        self.offsets = np.load(os.path.join(path, "docs_offsets.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "docs_ids.npy"), mmap_mode="r")
+        blob = os.path.join(path, "docs.bin")
+        self._blob = np.memmap(blob, dtype=np.uint8, mode="r") if os.path.getsize(blob) else np.zeros(0, np.uint8)
+        self._positions: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def document_at(self, pos: int) -> Document:
+        rec = json.loads(self._blob[int(self.offsets[pos]):int(self.offsets[pos + 1])].tobytes())
+        return Document(id=self.ids[pos].decode("utf-8"), page_content=rec["text"], metadata=rec["metadata"])
+
+    def search(self, search: str):
+        if self._positions is None:
+            with self._lock:
+                if self._positions is None:
+                    self._positions = {_id.decode("utf-8"): i for i, _id in enumerate(self.ids)}
+        pos = self._positions.get(search)
+        if pos is None:
+            return f"ID {search} not found."
+        return self.document_at(pos)
+
+    def delete(self, ids: list) -> None:
+        _ensure_writable(self)
+
+class _MmapIdMap(Mapping):
+    """FAISS 위치 → docstore id (docs_ids.npy를 그대로 읽는 읽기 전용 매핑)."""
+    def __init__(self, ids):
+        self._ids = ids
+
+    def __getitem__(self, pos):
+        pos = int(pos)
+        if not 0 <= pos < len(self._ids):
+            raise KeyError(pos)
+        return self._ids[pos].decode("utf-8")
+
+    def __iter__(self):
+        return iter(range(len(self._ids)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+def _write_mmap_docstore(vectorstore, path: str) -> None:
+    positions = sorted(vectorstore.index_to_docstore_id)
+    ids, offsets = [], [0]
+    with open(os.path.join(path, "docs.bin"), "wb") as f:
+        for pos in positions:
+            _id = vectorstore.index_to_docstore_id[pos]
+            doc = vectorstore.docstore.search(_id)
+            data = json.dumps({"text": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False).encode("utf-8")
+            f.write(data)
+            ids.append(_id.encode("utf-8"))
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(path, "docs_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(path, "docs_ids.npy"), np.asarray(ids, dtype=bytes) if ids else np.zeros(0, "S1"))
+
+def _load_mmap_vectorstore(path: str, embedding):
+    """index.faiss를 읽기 전용 mmap으로, 도크스토어는 MmapDocstore로 엽니다."""
+    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+    index = faiss.read_index(os.path.join(path, "index.faiss"), flags)
+    docstore = MmapDocstore(path)
+    if len(docstore) != index.ntotal:
+        raise RuntimeError("인덱스와 도크스토어의 청크 수가 다릅니다.")
+    return FAISS(embedding_function=embedding, index=index, docstore=docstore,
+                 index_to_docstore_id=_MmapIdMap(docstore.ids))
+
+def _load_docs_vectorstore(path: str, embedding):
+    """index.faiss와 docs.bin을 메모리로 읽어 들입니다 (제자리 수정 가능)."""
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    docs = MmapDocstore(path)
+    if len(docs) != index.ntotal:
+        raise RuntimeError("인덱스와 도크스토어의 청크 수가 다릅니다.")
+    by_pos = [docs.document_at(pos) for pos in range(len(docs))]
+    return FAISS(embedding_function=embedding, index=index,
+                 docstore=InMemoryDocstore({d.id: d for d in by_pos}),
+                 index_to_docstore_id={pos: d.id for pos, d in enumerate(by_pos)})
+
+def corpus_fingerprint(file_keys: Iterable[str]) -> str:
+    """파일별 인제스트 캐시 키 집합으로 코퍼스 지문을 만듭니다 (업로드 순서와 무관)."""
+    return hashlib.sha256("\n".join(sorted(set(file_keys))).encode("utf-8")).hexdigest()[:32]
+
+def save_vectorstore(vectorstore, fingerprint: str, embed_backend: str = "openai", sources: Optional[list] = None,
+                     replaces: Optional[str] = None) -> str:
+    """FAISS 인덱스/도크스토어/BM25 역색인을 VECTORSTORE_DIR/<지문>에 저장하고 최근 인덱스로 기록합니다.
+
+    도크스토어는 docs.bin(+오프셋/id 배열) 하나로만 저장합니다 (LangChain의 index.pkl은 쓰지 않음).
+    replaces를 주면 새 저장본이 최근 인덱스로 기록된 뒤 그 지문의 이전 저장본을 지웁니다
+    (이미 mmap으로 연 세션은 POSIX에서 지워진 파일을 그대로 계속 읽음).
+    """
+    path = os.path.join(VECTORSTORE_DIR, fingerprint)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    faiss.write_index(vectorstore.index, os.path.join(tmp, "index.faiss"))
+    _write_mmap_docstore(vectorstore, tmp)
+    get_bm25_index(vectorstore, fingerprint).save(tmp)
+    _save_minhash(vectorstore, tmp)
+    _save_category_masks(vectorstore, tmp)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"backend": (embed_backend or "openai").lower(), "sources": sources or []}, f, ensure_ascii=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    with open(os.path.join(VECTORSTORE_DIR, "latest"), "w", encoding="utf-8") as f:
+        f.write(fingerprint)
+    if replaces and replaces != fingerprint:
+        shutil.rmtree(os.path.join(VECTORSTORE_DIR, replaces), ignore_errors=True)
+    return path
+
+def load_vectorstore(fingerprint: str, embed_backend: Optional[str] = None):
+    """저장된 인덱스를 불러옵니다. 없거나 읽을 수 없으면 None.
+
+    VECTORSTORE_MMAP이면 인덱스와 도크스토어를 읽기 전용 mmap으로 엽니다 (이 경우 제자리 수정 불가).
+    """
+    path = os.path.join(VECTORSTORE_DIR, fingerprint)
+    try:
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        backend = embed_backend or meta.get("backend", "openai")
+        if backend != meta.get("backend", backend):
+            return None
+        vs = None
+        if os.path.exists(os.path.join(path, "docs_ids.npy")):
+            if VECTORSTORE_MMAP:
+                try:
+                    vs = _load_mmap_vectorstore(path, get_embedding(backend))
+                except Exception:
+                    vs = None
+            if vs is None:
+                vs = _load_docs_vectorstore(path, get_embedding(backend))
+        else:
+            # index.pkl로 저장하던 이전 형식. 이 앱이 직접 저장한 파일만 읽으므로 pickle 역직렬화 허용
+            vs = FAISS.load_local(path, get_embedding(backend), allow_dangerous_deserialization=True)
+        _init_search_params(vs.index)
+        bm25 = BM25Index.load(path)
+        if bm25 is not None and bm25.n_docs == vs.index.ntotal:
+            _attach_bm25_index(vs, fingerprint, bm25)
+        _load_minhash(vs, path)
+        _load_category_masks(vs, path)
+        return vs
+    except Exception:
+        return None
+
+def load_latest_vectorstore():
+    """가장 최근에 저장된 인덱스를 (지문, 벡터스토어)로 반환. 없으면 (None, None)."""
+    try:
+        with open(os.path.join(VECTORSTORE_DIR, "latest"), encoding="utf-8") as f:
+            fingerprint = f.read().strip()
+    except Exception:
+        return None, None
+    vs = _VS_REGISTRY.get_or_load(fingerprint, lambda: load_vectorstore(fingerprint)) if fingerprint else None
+    return (fingerprint, vs) if vs is not None else (None, None)
+
+def _embed_texts(embedding, texts: list[str], progress=None) -> list:
+    if isinstance(embedding, (ScheduledEmbeddings, CachedEmbeddings)):
+        return embedding.embed_documents(texts, progress=progress)
+    vectors = embedding.embed_documents(texts)
+    if progress is not None:
+        progress(len(texts), len(texts))
+    return vectors
+
+def _has_ingest_cache(key: str) -> bool:
+    base = os.path.join(INGEST_CACHE_DIR, key)
+    return os.path.exists(base + ".json") and os.path.exists(base + ".npy")
+
+# 근사 중복 청크 제거 (MinHash + LSH): 반복되는 머리말/꼬리말/슬라이드 템플릿/페이지를 임베딩 전에 걸러냄
+DEDUP_JACCARD = float(os.getenv("DEDUP_JACCARD", "0.85"))  # 0이면 끔
+_MINHASH_PRIME = (1 << 31) - 1
+
+class NearDuplicateFilter:
+    """문자 shingle의 MinHash 서명을 LSH 밴드로 버킷팅해, 이미 본 청크와 추정 Jaccard 유사도가
+    threshold 이상인 청크를 중복으로 판정합니다.
+
+    shingle 해시는 mmh3로 한 번만 구하고, num_perm개의 해시 함수는 (a·h + b) mod p로 벡터화합니다.
+    밴드 하나(rows개 값)가 같은 청크만 후보로 보고, 후보는 서명 일치 비율로 최종 확인합니다.
+    이미 인덱스에 있는 청크는 저장된 서명 행렬을 add_signatures로 한꺼번에 등록합니다 (밴드 해시 정렬 배열).
+    """
+    def __init__(self, threshold: float = DEDUP_JACCARD, num_perm: int = 128, bands: int = 32,
+                 shingle: int = 5, seed: int = 1):
+        if not HAS_MMH3:
+            raise RuntimeError("근사 중복 제거 사용 불가: `mmh3` 설치 필요")
+        rng = np.random.default_rng(seed)
+        self.threshold = threshold
+        self.shingle = shingle
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._a = rng.integers(1, _MINHASH_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MINHASH_PRIME, num_perm, dtype=np.uint64)
+        # 밴드별 곱셈 해시 (a/b 뒤에 뽑으므로 저장된 서명과 호환)
+        self._mult = rng.integers(1, np.iinfo(np.int64).max, (bands, self.rows), dtype=np.uint64) | np.uint64(1)
+        self._buckets: dict = {}
+        self._sigs: list = []
+        self._base = None        # add_signatures로 등록한 서명 행렬 (n×num_perm)
+        self._base_keys = None   # 그 밴드 해시들을 정렬한 1차원 배열
+        self._base_rows = None   # 정렬된 밴드 해시 → 서명 행 번호
+
+    def signature(self, text: str):
+        norm = " ".join((text or "").lower().split())
+        if not norm:
+            return None
+        k = self.shingle
+        grams = {norm[i:i + k] for i in range(max(1, len(norm) - k + 1))}
+        h = np.fromiter((mmh3.hash(g, signed=False) for g in grams), dtype=np.uint64, count=len(grams))
+        h %= _MINHASH_PRIME
+        return ((h[:, None] * self._a[None, :] + self._b[None, :]) % _MINHASH_PRIME).min(axis=0)
+
+    def _band_hashes(self, sigs) -> np.ndarray:
+        # (n, num_perm) → (n, bands) uint64, 밴드마다 다른 곱셈 해시 (2^64에서 wrap). 행 블록 단위로 계산해 메모리 절약
+        out = np.empty((len(sigs), self.bands), dtype=np.uint64)
+        for i in range(0, len(sigs), 16384):
+            block = np.asarray(sigs[i:i + 16384], dtype=np.uint64).reshape(-1, self.bands, self.rows)
+            out[i:i + 16384] = (block * self._mult[None]).sum(axis=2, dtype=np.uint64)
+        return out
+
+    def add_signatures(self, sigs) -> None:
+        """이미 본 청크들의 서명 행렬을 한 번에 등록합니다 (청크마다 shingle·서명을 다시 계산하지 않음)."""
+        sigs = np.asarray(sigs).reshape(-1, len(self._a))
+        if not len(sigs):
+            return
+        keys = self._band_hashes(sigs).ravel()
+        order = np.argsort(keys, kind="stable")
+        self._base = sigs
+        self._base_keys = keys[order]
+        self._base_rows = order // self.bands
+
+    def _band_keys(self, sig):
+        r = self.rows
+        return [(b, sig[b * r:(b + 1) * r].tobytes()) for b in range(self.bands)]
+
+    def add(self, text: str) -> None:
+        sig = self.signature(text)
+        if sig is not None:
+            self._insert(sig)
+
+    def _insert(self, sig) -> None:
+        idx = len(self._sigs)
+        self._sigs.append(sig)
+        for key in self._band_keys(sig):
+            self._buckets.setdefault(key, []).append(idx)
+
+    def is_duplicate(self, text: str) -> bool:
+        """중복이면 True. 중복이 아니면 이후 비교를 위해 기억해 둡니다 (빈 텍스트는 항상 False)."""
+        sig = self.signature(text)
+        return sig is not None and self.check(sig)
+
+    def check(self, sig) -> bool:
+        """서명으로 중복 여부를 판정합니다 (is_duplicate와 같되 서명을 직접 받음)."""
+        if self._base is not None:
+            q = self._band_hashes(sig[None, :])[0]
+            lo = np.searchsorted(self._base_keys, q, "left")
+            hi = np.searchsorted(self._base_keys, q, "right")
+            spans = [self._base_rows[a:b] for a, b in zip(lo, hi) if b > a]
+            if spans:
+                rows = np.unique(np.concatenate(spans))
+                if (np.mean(self._base[rows] == sig, axis=1) >= self.threshold).any():
+                    return True
+        seen = set()
+        for key in self._band_keys(sig):
+            for idx in self._buckets.get(key, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                if np.mean(self._sigs[idx] == sig) >= self.threshold:
+                    return True
+        self._insert(sig)
+        return False
+
+# 인덱스 청크의 MinHash 서명: docstore id와 함께 벡터스토어별로 보관하고 인덱스 옆(minhash.npz)에 저장해,
+# 증분 추가 때 기존 청크를 다시 shingle·서명하지 않음 (인덱스에 없는 id의 서명은 쓰지 않고 저장 때 버림)
+_MINHASH_SIGS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 벡터스토어 → {"ids", "blocks"}
+_MINHASH_LOCK = threading.Lock()
+
+def _record_minhash(vectorstore, ids: list[str], sigs: list) -> None:
+    if not ids:
+        return
+    block = np.asarray(sigs, dtype=np.uint32)
+    with _MINHASH_LOCK:
+        entry = _MINHASH_SIGS.setdefault(vectorstore, {"ids": [], "blocks": []})
+        entry["ids"].extend(ids)
+        entry["blocks"].append(block)
+
+def _minhash_entry(vectorstore) -> Optional[tuple]:
+    """(ids, 서명 행렬) 중 현재 인덱스에 있는 id만. 기록이 없으면 None."""
+    current = set(vectorstore.index_to_docstore_id.values())
+    with _MINHASH_LOCK:
+        entry = _MINHASH_SIGS.get(vectorstore)
+        if entry is None:
+            return None
+        if len(entry["blocks"]) > 1:
+            entry["blocks"] = [np.concatenate(entry["blocks"])]
+        ids, sigs = list(entry["ids"]), (entry["blocks"][0] if entry["blocks"] else None)
+    last: dict = {}  # 같은 id를 다시 추가했으면 마지막 서명
+    for i, _id in enumerate(ids):
+        if _id in current:
+            last[_id] = i
+    if sigs is None or not last:
+        return [], np.zeros((0, 0), dtype=np.uint32)
+    return list(last), sigs[list(last.values())]
+
+def _minhash_signatures(vectorstore, dedup: NearDuplicateFilter) -> np.ndarray:
+    """인덱스의 모든 청크 서명 행렬. 기록에 없는 청크만 docstore에서 읽어 서명하고 기록에 더합니다."""
+    found = _minhash_entry(vectorstore)
+    ids, sigs = found if found is not None else ([], np.zeros((0, 0), dtype=np.uint32))
+    if len(ids) and sigs.shape[1] != len(dedup._a):
+        ids, sigs = [], np.zeros((0, 0), dtype=np.uint32)
+    known = set(ids)
+    new_ids, new_sigs = [], []
+    for _id in vectorstore.index_to_docstore_id.values():
+        if _id in known:
+            continue
+        doc = vectorstore.docstore.search(_id)
+        sig = dedup.signature(doc.page_content) if isinstance(doc, Document) else None
+        if sig is not None:
+            new_ids.append(_id)
+            new_sigs.append(sig)
+    _record_minhash(vectorstore, new_ids, new_sigs)
+    blocks = [b for b in (sigs, np.asarray(new_sigs, dtype=np.uint32)) if b.size]
+    return np.concatenate(blocks) if blocks else np.zeros((0, len(dedup._a)), dtype=np.uint32)
+
+def _save_minhash(vectorstore, path: str) -> None:
+    found = _minhash_entry(vectorstore)
+    if found is None or not found[0]:
+        return
+    ids, sigs = found
+    np.savez(os.path.join(path, "minhash.npz"), ids=np.asarray(ids, dtype=str), sigs=sigs)
+
+def _load_minhash(vectorstore, path: str) -> None:
+    try:
+        with np.load(os.path.join(path, "minhash.npz")) as z:
+            ids, sigs = z["ids"].tolist(), z["sigs"]
+    except Exception:
+        return
+    with _MINHASH_LOCK:
+        _MINHASH_SIGS[vectorstore] = {"ids": ids, "blocks": [sigs]}
+
+def _copy_minhash(src, dst) -> None:
+    with _MINHASH_LOCK:
+        entry = _MINHASH_SIGS.get(src)
+        if entry is not None:
+            # 서명 블록은 제자리 수정하지 않으므로 배열은 공유
+            _MINHASH_SIGS[dst] = {"ids": list(entry["ids"]), "blocks": list(entry["blocks"])}
+
+# 스트리밍 인제스트: 페이지 → 청크 → 임베딩 배치 → 인덱스 추가
+INGEST_WINDOW_CHUNKS = int(os.getenv("INGEST_WINDOW_CHUNKS", "512"))
+
+def _iter_chunk_records(payloads: list[tuple[str, bytes]], keys: list[str], splitter, workers, stats: dict):
+    """파일 순서대로 청크 레코드를 흘려보냅니다.
+
+    청크: {"file", "text", "metadata", "id", "vector"} (캐시 적중 파일은 vector가 채워져 있음)
+    파일 끝: {"file_end", "pages"} (pages는 캐시 미스 파일에서 파싱한 페이지, 적중 시 None)
+    청크 id는 "<파일 키 앞 16자>-<청크 순번>"으로 정해져 있어 같은 파일은 항상 같은 id를 가집니다.
+    """
+    hit = [_has_ingest_cache(k) for k in keys]
+    misses = [i for i, h in enumerate(hit) if not h]
+    pages_it = _iter_pdf_pages([payloads[i] for i in misses], workers=workers, file_stats=stats["page_stats"])
+    try:
+        for i, (name, _) in enumerate(payloads):
+            meta = {"source": name, "file_key": keys[i]}  # 같은 PDF를 다른 이름으로 올려도 현재 파일명이 출처
+            entry = _load_ingest_cache(keys[i]) if hit[i] else None
+            if entry is not None:
+                stats["pages"] += len(entry.get("pages", []))
+                for n, (c, v) in enumerate(zip(entry["chunks"], entry["vectors"])):
+                    # 중복으로 빠져 임베딩하지 않았던 청크는 NaN 행으로 저장돼 있음
+                    missing = v.size == 0 or bool(np.isnan(v).any())
+                    yield {"file": i, "text": c["text"], "metadata": {**c["metadata"], **meta},
+                           "id": f"{keys[i][:16]}-{n}", "vector": None if missing else v, "cached": True}
+                yield {"file_end": i, "pages": None}
+                continue
+            # 캐시 파일이 손상된 경우엔 이 파일만 따로 직렬 파싱
+            source = pages_it if not hit[i] else _iter_pdf_pages([payloads[i]], workers=1, file_stats=stats["page_stats"])
+            pages, n = [], 0
+            for _, page in source:
+                if page is None:
+                    break
+                pages.append(page)
+                stats["pages"] += 1
+                stats["file_fraction"] = (page.metadata["page"] + 1) / max(page.metadata["total_pages"], 1)
+                for c in splitter.split_documents([page]):
+                    yield {"file": i, "text": c.page_content, "metadata": {**c.metadata, **meta},
+                           "id": f"{keys[i][:16]}-{n}", "vector": None}
+                    n += 1
+            yield {"file_end": i, "pages": pages}
+    finally:
+        pages_it.close()
+
+class IngestCancelled(RuntimeError):
+    """cancel 이벤트로 인제스트가 중단됨."""
+
+def _run_ingest(vectorstore, payloads: list[tuple[str, bytes]], keys: list[str], embedding,
+                workers: Optional[int] = None, progress=None, window: Optional[int] = None, cancel=None):
+    """청크를 window개씩 모아 임베딩하고 바로 인덱스에 넣는 스트리밍 인제스트.
+
+    메모리에는 현재 윈도(청크/벡터)와 캐시 기록을 위한 진행 중 파일의 청크만 남으므로
+    코퍼스 크기와 무관하게 (인덱스 자체를 제외하면) 사용량이 일정합니다.
+    vectorstore가 None이면 첫 윈도로 새 FAISS 인덱스를 만들어 반환합니다.
+    progress(stats)에는 윈도마다 files/files_done/pages/chunks/embedded/elapsed/chunks_per_sec/fraction과
+    tokens_embedded(이번에 임베딩 API로 보낸 토큰 수), chunk_mode(분할 모드)가 전달됩니다.
+    DEDUP_JACCARD > 0이면 이미 인덱스에 있거나 앞서 나온 청크와 근사 중복인 청크는 임베딩·인덱싱하지 않고
+    stats["dropped"](합계)와 stats["dropped_per_file"](파일명 → 개수)에 집계합니다.
+    stats["page_stats"]에는 새로 파싱한 파일별 페이지 추출/캐시/건너뜀 수와 추출 시간이 들어갑니다.
+    stats["index_s"]는 FAISS 인덱스에 벡터를 넣는 데 쓴 누적 시간(초)입니다.
+    청크마다 metadata["categories"]에 tag_categories 결과(공정 카테고리 목록)를 붙이고, 캐시에서 읽은 청크도
+    태깅 규칙 버전(metadata["category_rules"])이 다르면 다시 태깅합니다.
+    인제스트 캐시에는 중복 여부와 무관하게 파일의 모든 청크가 남으므로 청크 id는 그대로 유지됩니다.
+    cancel(threading.Event)이 설정되면 IngestCancelled를 올립니다. 그때까지 끝난 파일은 캐시에 남습니다.
+    """
+    window = window or INGEST_WINDOW_CHUNKS
+    splitter = _make_splitter()
+    enc = _token_encoder()
+    stats = {"files": len(payloads), "files_done": 0, "file_fraction": 0.0, "pages": 0, "chunks": 0,
+             "embedded": 0, "tokens_embedded": 0, "chunk_mode": SPLITTER_SETTINGS.get("mode", "char"),
+             "dropped": 0, "dropped_per_file": {}, "page_stats": {}, "index_s": 0.0,
+             "elapsed": 0.0, "chunks_per_sec": 0.0, "fraction": 0.0}
+    dedup = NearDuplicateFilter() if DEDUP_JACCARD > 0 and HAS_MMH3 else None
+    if dedup is not None and vectorstore is not None:
+        dedup.add_signatures(_minhash_signatures(vectorstore, dedup))
+    t0 = time.monotonic()
+    buf: list = []
+    pending: dict = {}   # 캐시 미스 파일 → 캐시에 기록할 청크/벡터
+    ended: list = []     # 파일 끝에 도달했지만 아직 버퍼에 청크가 남아 있을 수 있는 파일
+
+    def flush():
+        nonlocal vectorstore
+        if buf:
+            need = [r for r in buf if r["vector"] is None and not r["dropped"]]
+            if need:
+                for r, v in zip(need, _embed_texts(embedding, [r["text"] for r in need])):
+                    r["vector"] = v
+                stats["embedded"] += len(need)
+                stats["tokens_embedded"] += sum(_prepare_embed_input(r["text"], enc)[1] for r in need)
+            kept = [r for r in buf if not r["dropped"]]
+            pairs = [(r["text"], r["vector"]) for r in kept]
+            metadatas = [r["metadata"] for r in kept]
+            ids = [r["id"] for r in kept]
+            base = int(vectorstore.index.ntotal) if vectorstore is not None else 0
+            t_index = time.perf_counter()
+            if kept and vectorstore is None:
+                vectorstore = FAISS.from_embeddings(pairs, embedding, metadatas=metadatas, ids=ids)
+            elif kept:
+                vectorstore.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+            stats["index_s"] += time.perf_counter() - t_index
+            if kept:
+                _append_category_masks(vectorstore, base, [_category_mask(m["categories"]) for m in metadatas])
+            signed = [r for r in kept if r["sig"] is not None]
+            _record_minhash(vectorstore, [r["id"] for r in signed], [r["sig"] for r in signed])
+            for r in buf:
+                if r["file"] in pending:
+                    pending[r["file"]]["chunks"].append(Document(page_content=r["text"], metadata=r["metadata"]))
+                    pending[r["file"]]["vectors"].append(r["vector"])
+            stats["chunks"] += len(kept)
+            buf.clear()
+        for i, pages in ended:
+            entry = pending.pop(i)
+            _save_ingest_cache(keys[i], pages, entry["chunks"], entry["vectors"])
+        ended.clear()
+        stats["elapsed"] = time.monotonic() - t0
+        stats["chunks_per_sec"] = stats["chunks"] / stats["elapsed"] if stats["elapsed"] > 0 else 0.0
+        stats["fraction"] = min(1.0, (stats["files_done"] + stats["file_fraction"]) / max(stats["files"], 1))
+        if progress is not None:
+            progress(dict(stats))
+
+    for rec in _iter_chunk_records(payloads, keys, splitter, workers, stats):
+        if cancel is not None and cancel.is_set():
+            raise IngestCancelled("인제스트가 취소되었습니다.")
+        if "file_end" in rec:
+            stats["files_done"] += 1
+            stats["file_fraction"] = 0.0
+            if rec["pages"] is not None:
+                pending.setdefault(rec["file_end"], {"chunks": [], "vectors": []})
+                ended.append((rec["file_end"], rec["pages"]))
+            continue
+        if not rec.get("cached"):
+            pending.setdefault(rec["file"], {"chunks": [], "vectors": []})
+        if rec["metadata"].get("category_rules") != _CATEGORY_RULES_VERSION:
+            rec["metadata"]["categories"] = tag_categories(rec["text"])
+            rec["metadata"]["category_rules"] = _CATEGORY_RULES_VERSION
+        rec["sig"] = dedup.signature(rec["text"]) if dedup is not None else None
+        rec["dropped"] = rec["sig"] is not None and dedup.check(rec["sig"])
+        if rec["dropped"]:
+            stats["dropped"] += 1
+            name = rec["metadata"]["source"]
+            stats["dropped_per_file"][name] = stats["dropped_per_file"].get(name, 0) + 1
+        buf.append(rec)
+        if len(buf) >= window:
+            flush()
+    flush()
+    return vectorstore
+
+def _iter_docstore(vectorstore):
+    """(docstore id, Document)를 인덱스 순서대로 순회합니다."""
+    for _id in list(vectorstore.index_to_docstore_id.values()):
+        doc = vectorstore.docstore.search(_id)
+        if isinstance(doc, Document):
+            yield _id, doc
+
+def vectorstore_sources(vectorstore) -> list[str]:
+    """인덱스에 들어 있는 문서 출처(파일명) 목록 (인덱스 순서, 중복 제거)."""
+    return list(dict.fromkeys(doc.metadata.get("source", "") for _, doc in _iter_docstore(vectorstore)))
+
+def vectorstore_fingerprint(vectorstore) -> str:
+    """인덱스에 들어 있는 파일 키들로 코퍼스 지문을 다시 계산합니다."""
+    return corpus_fingerprint(doc.metadata.get("file_key", "") for _, doc in _iter_docstore(vectorstore))
+
+# FAISS 인덱스 종류: 벡터 수에 따라 Flat(정확) / HNSW(그래프) / IVF-PQ(압축)
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto").strip().lower()  # auto | flat | hnsw | ivfpq
+FAISS_HNSW_MIN = int(os.getenv("FAISS_HNSW_MIN", "20000"))
+FAISS_IVFPQ_MIN = int(os.getenv("FAISS_IVFPQ_MIN", "200000"))
+FAISS_HNSW_M = 32
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "128"))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+# 인덱스 안 벡터 저장 형식 (float32 | fp16 | int8)과 PCA 축소 차원 (0이면 안 함). IVF-PQ는 자체 PQ 코드를 씀
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "float32").strip().lower()
+VECTOR_PCA_DIM = int(os.getenv("VECTOR_PCA_DIM", "0"))
+_SQ_TYPES = {"fp16": "QT_fp16", "int8": "QT_8bit"}
+
+def choose_index_type(n_vectors: int) -> str:
+    """FAISS_INDEX_TYPE이 auto면 벡터 수로 인덱스 종류를 고릅니다."""
+    if FAISS_INDEX_TYPE in ("flat", "hnsw", "ivfpq"):
+        return FAISS_INDEX_TYPE
+    if n_vectors >= FAISS_IVFPQ_MIN:
+        return "ivfpq"
+    if n_vectors >= FAISS_HNSW_MIN:
+        return "hnsw"
+    return "flat"
+
+_PQ_NBITS = 8
+
+def _feasible_index_kind(kind: str, n_vectors: int) -> str:
+    """ivfpq는 PQ 코드북(2**nbits개 중심)을 학습할 벡터가 있을 때만 씁니다 (nlist는 n//39 이하로 잡으므로 충분).
+    부족하면 HNSW(FAISS_HNSW_MIN 이상) 또는 flat으로 바꾸고 경고를 남깁니다."""
+    if kind != "ivfpq" or n_vectors >= 2 ** _PQ_NBITS:
+        return kind
+    fallback = "hnsw" if n_vectors >= FAISS_HNSW_MIN else "flat"
+    logger.warning("벡터 %d개로는 IVF-PQ를 학습할 수 없어 %s 인덱스를 씁니다 (최소 %d개)",
+                   n_vectors, fallback, 2 ** _PQ_NBITS)
+    return fallback
+
+def _core_index(index):
+    """IndexPreTransform(PCA)로 감싼 경우 안쪽 인덱스."""
+    if isinstance(index, faiss.IndexPreTransform):
+        return faiss.downcast_index(index.index)
+    return index
+
+def index_layout(index) -> dict:
+    """{"kind", "storage", "pca_dim"} — 인덱스 종류, 벡터 저장 형식, PCA 축소 차원(없으면 0)."""
+    core = _core_index(index)
+    storage = "float32"
+    codes = faiss.downcast_index(core.storage) if isinstance(core, faiss.IndexHNSW) else core
+    sq = getattr(codes, "sq", None)
+    if sq is not None:
+        storage = "fp16" if sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return {"kind": index_type(core), "storage": storage,
+            "pca_dim": core.d if core is not index else 0}
+
+def index_type(index) -> str:
+    index = _core_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+def _pq_subquantizers(d: int) -> int:
+    """PQ 서브벡터 수 m: d를 나누면서 서브벡터당 4차원 이상이 되는 가장 큰 값."""
+    for m in (64, 48, 32, 16, 8, 4, 2):
+        if d % m == 0 and d // m >= 4:
+            return m
+    return 1
+
+def make_faiss_index(vectors, kind: Optional[str] = None, storage: Optional[str] = None,
+                     pca_dim: Optional[int] = None, seed: int = 0):
+    """vectors(n×d float32)를 담은 FAISS 인덱스를 만듭니다 (L2 거리, LangChain FAISS 기본값과 동일).
+
+    ivfpq는 nlist≈4√n개 리스트, 8비트 PQ 코드를 쓰며 벡터 중 최대 64·nlist개 표본으로 학습합니다.
+    벡터가 256개 미만이면 PQ를 학습할 수 없어 flat(또는 HNSW)으로 만듭니다.
+    storage가 fp16/int8이면 flat/hnsw 벡터를 스칼라 양자화해 2배/4배 작게 저장하고,
+    pca_dim이 있으면 벡터 표본으로 PCA를 학습해 그 차원으로 줄인 뒤 저장합니다 (질의도 같은 변환을 거침).
+    PCA는 벡터 수가 pca_dim보다 많을 때만 적용합니다.
+    """
+    x = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = x.shape
+    kind = _feasible_index_kind(kind or choose_index_type(n), n)
+    storage = storage or VECTOR_STORAGE
+    pca_dim = VECTOR_PCA_DIM if pca_dim is None else pca_dim
+    if not (0 < pca_dim < d and n > pca_dim):
+        pca_dim = 0
+    dim = pca_dim or d
+    qtype = getattr(faiss.ScalarQuantizer, _SQ_TYPES[storage]) if storage in _SQ_TYPES else None
+    nlist = max(1, min(int(4 * n ** 0.5), n // 39))
+    if kind == "hnsw":
+        index = faiss.IndexHNSWSQ(dim, qtype, FAISS_HNSW_M) if qtype is not None else faiss.IndexHNSWFlat(dim, FAISS_HNSW_M)
+        index.hnsw.efConstruction = 80
+    elif kind == "ivfpq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, _pq_subquantizers(dim), _PQ_NBITS)
+    elif qtype is not None:
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+    else:
+        index = faiss.IndexFlatL2(dim)
+    if pca_dim:
+        index = faiss.IndexPreTransform(faiss.PCAMatrix(d, pca_dim), index)
+    if not index.is_trained and n:
+        sample = x
+        if n > max(64 * nlist, 100_000):
+            sample = x[np.random.default_rng(seed).choice(n, max(64 * nlist, 100_000), replace=False)]
+        index.train(sample)
+    if n:
+        index.add(x)
+    _init_search_params(index)
+    return index
+
+def _init_search_params(index) -> None:
+    """새로 만들거나 불러와 아직 공유하지 않은 인덱스에 기본 탐색 폭(FAISS_EF_SEARCH / FAISS_NPROBE)을 넣습니다.
+    LangChain similarity_search처럼 파라미터 없이 검색하는 경로용이며, 이 모듈의 검색은 _search_params를 씁니다."""
+    core = _core_index(index)
+    if isinstance(core, faiss.IndexHNSW):
+        core.hnsw.efSearch = FAISS_EF_SEARCH
+    elif isinstance(core, faiss.IndexIVF):
+        core.nprobe = min(FAISS_NPROBE, core.nlist)
+
+def _index_vectors(index):
+    """인덱스에 든 벡터 전체 (n×d). IVF-PQ/양자화/PCA 인덱스는 압축 코드에서 복원한 근사값입니다."""
+    core = _core_index(index)
+    if isinstance(core, faiss.IndexIVF):
+        core.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+
+def adapt_vectorstore_index(vectorstore, kind: Optional[str] = None) -> str:
+    """현재 벡터 수에 맞는 인덱스 종류/저장 형식(VECTOR_STORAGE, VECTOR_PCA_DIM)이 아니면
+    같은 순서로 다시 만들어 교체하고, 최종 종류를 반환합니다.
+
+    IVF-PQ에서 다른 종류로는 되돌리지 않습니다 (원본 벡터가 없어 복원값이 근사이므로).
+    docstore/index_to_docstore_id는 위치가 그대로라 건드리지 않습니다.
+    """
+    index = vectorstore.index
+    layout = index_layout(index)
+    kind = _feasible_index_kind(kind or choose_index_type(index.ntotal), index.ntotal)
+    pca_dim = VECTOR_PCA_DIM if 0 < VECTOR_PCA_DIM < index.d and index.ntotal > VECTOR_PCA_DIM else 0
+    storage = VECTOR_STORAGE if kind != "ivfpq" and VECTOR_STORAGE in _SQ_TYPES else "float32"
+    if layout["kind"] == "ivfpq" or layout == {"kind": kind, "storage": storage, "pca_dim": pca_dim}:
+        return layout["kind"]
+    vectorstore.index = make_faiss_index(_index_vectors(index), kind)
+    return kind
+
+STORAGE_BENCH_CONFIGS = [
+    {"storage": "fp16"},
+    {"storage": "int8"},
+    {"dimensions": 512, "storage": "fp16"},
+    {"dimensions": 512, "storage": "int8"},
+    {"dimensions": 256, "storage": "int8"},
+    {"pca_dim": 256, "storage": "int8"},
+    {"kind": "hnsw", "storage": "int8"},
+]
+
+def storage_recall_report(vectors, configs: Optional[list] = None, k: int = 10, n_queries: int = 200,
+                          seed: int = 0) -> list[dict]:
+    """축소 차원/PCA/양자화 설정별 recall@k와 벡터당 바이트를 전체 정밀도(flat float32)와 비교합니다.
+
+    질의는 코퍼스 벡터 중 무작위 표본이며 자기 자신은 결과에서 뺍니다.
+    dimensions는 text-embedding-3의 축소 차원 응답과 같은 방식(앞쪽 성분만 남기고 다시 정규화)으로 흉내 내므로
+    임베딩 API를 다시 호출하지 않습니다.
+    """
+    x = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = x.shape
+    k = min(k, n - 1)
+    rng = np.random.default_rng(seed)
+    qpos = rng.choice(n, min(n_queries, n), replace=False)
+
+    def top_k(index, q):
+        _, found = index.search(q, k + 1)
+        return [[j for j in row if j != p and j >= 0][:k] for p, row in zip(qpos, found)]
+
+    base = faiss.IndexFlatL2(d)
+    base.add(x)
+    truth = top_k(base, x[qpos])
+    base_bytes = len(faiss.serialize_index(base)) / n
+    rows = []
+    for cfg in [{}] + list(configs or STORAGE_BENCH_CONFIGS):
+        dims = cfg.get("dimensions")
+        if dims and dims >= d:
+            continue
+        xs = x
+        if dims:
+            xs = np.ascontiguousarray(x[:, :dims])
+            xs /= np.maximum(np.linalg.norm(xs, axis=1, keepdims=True), 1e-12)
+        t0 = time.perf_counter()
+        index = make_faiss_index(xs, cfg.get("kind", "flat"), cfg.get("storage", "float32"), cfg.get("pca_dim", 0))
+        build = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        got = top_k(index, xs[qpos])
+        search_ms = (time.perf_counter() - t0) * 1000 / len(qpos)
+        recall = float(np.mean([len(set(g) & set(t)) / max(len(t), 1) for g, t in zip(got, truth)]))
+        size = len(faiss.serialize_index(index)) / n
+        rows.append({"config": cfg or {"storage": "float32"}, "k": k, "recall": round(recall, 4),
+                     "bytes_per_vector": round(size, 1), "compression": round(base_bytes / size, 2),
+                     "build_s": round(build, 3), "search_ms": round(search_ms, 3)})
+    return rows
+
+def _ensure_writable(vectorstore) -> None:
+    # mmap으로 연 인덱스를 FAISS가 직접 고치려 하면 읽기 전용 매핑에 쓰다가 프로세스가 죽으므로 미리 막음
+    # (벡터스토어 또는 도크스토어를 받음)
+    if isinstance(getattr(vectorstore, "docstore", vectorstore), MmapDocstore):
+        raise RuntimeError("읽기 전용(mmap) 인덱스입니다. clone_vectorstore() 사본을 수정하세요.")
+
+def _renumber_ivf_ids(core, keep: list[int], old_n: int) -> None:
+    """remove_ids 뒤에도 IVF 역리스트에 남아 있는 원래 라벨을 0..len(keep)-1로 다시 매깁니다 (PQ 코드는 그대로)."""
+    remap = np.full(old_n, -1, dtype=np.int64)
+    remap[np.asarray(keep, dtype=np.int64)] = np.arange(len(keep), dtype=np.int64)
+    invlists = core.invlists
+    for list_no in range(core.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            labels = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+            labels[:] = remap[labels]
+
+def _delete_from_vectorstore(vectorstore, ids: list[str]) -> None:
+    """docstore id들을 삭제합니다. 남은 청크는 원래 순서대로 위치 0..n-1로 당겨집니다.
+
+    Flat/양자화 인덱스는 remove_ids가 위치를 당겨 주므로 LangChain FAISS.delete를 그대로 씁니다.
+    IVF는 remove_ids 뒤에도 원래 라벨을 유지하므로 역리스트의 라벨을 새 위치로 다시 매기고,
+    remove_ids를 지원하지 않는 HNSW는 남은 벡터로 인덱스를 다시 만듭니다.
+    카테고리 마스크도 같은 위치만 남깁니다.
+    """
+    drop = set(ids)
+    pos_map = vectorstore.index_to_docstore_id
+    keep = [pos for pos in sorted(pos_map) if pos_map[pos] not in drop]
+    _keep_category_masks(vectorstore, keep)
+    core = _core_index(vectorstore.index)
+    if isinstance(core, faiss.IndexIVF):
+        old_n = int(vectorstore.index.ntotal)
+        core.make_direct_map(False)  # Array direct map이 있으면 remove_ids가 거부됨
+        removed = np.asarray(sorted(set(range(old_n)) - set(keep)), dtype=np.int64)
+        vectorstore.index.remove_ids(removed)
+        _renumber_ivf_ids(core, keep, old_n)
+        vectorstore.docstore.delete(ids)
+        vectorstore.index_to_docstore_id = {new: pos_map[old] for new, old in enumerate(keep)}
+        return
+    if not isinstance(core, faiss.IndexHNSW):
+        vectorstore.delete(ids)
+        return
+    vectors = _index_vectors(vectorstore.index)[keep] if keep else np.zeros((0, vectorstore.index.d), np.float32)
+    vectorstore.index = make_faiss_index(vectors, "hnsw")
+    vectorstore.docstore.delete(ids)
+    vectorstore.index_to_docstore_id = {new: pos_map[old] for new, old in enumerate(keep)}
+
+# 공유 인덱스 레지스트리: 같은 코퍼스를 쓰는 세션들이 FAISS 인덱스/도크스토어 하나를 함께 참조
+class VectorStoreRegistry:
+    """코퍼스 지문 → 벡터스토어를 프로세스 전체에서 하나씩만 들고 있는 레지스트리.
+
+    벡터스토어는 약한 참조로만 보관하므로, 세션들의 참조(st.session_state.vectorstore)가 모두 사라지면
+    자동으로 메모리에서 빠집니다. 세션은 lease()로 받은 임대 객체를 세션 상태에 두고,
+    임대 객체가 사라지면(세션 종료·다른 코퍼스로 교체) 해당 코퍼스의 세션 수가 줄어듭니다.
+    같은 지문을 여러 세션이 동시에 요청해도 로드/빌드는 한 번만 실행됩니다.
+    공유 벡터스토어는 제자리에서 바꾸지 말고 clone_vectorstore()로 복사한 뒤 수정합니다.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stores: "weakref.WeakValueDictionary[str, object]" = weakref.WeakValueDictionary()
+        self._fingerprints: "weakref.WeakKeyDictionary[object, str]" = weakref.WeakKeyDictionary()
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._sessions: dict[str, int] = {}
+
+    def get(self, fingerprint: str):
+        with self._lock:
+            return self._stores.get(fingerprint)
+
+    def put(self, fingerprint: str, vectorstore):
+        """벡터스토어를 지문으로 등록합니다. 이미 같은 지문이 있으면 기존 것을 돌려줍니다."""
+        with self._lock:
+            cur = self._stores.get(fingerprint)
+            if cur is not None:
+                return cur
+            # 제자리에서 수정된 벡터스토어라면 예전 지문 항목은 더 이상 맞지 않으므로 뺌
+            old = self._fingerprints.get(vectorstore)
+            if old is not None and self._stores.get(old) is vectorstore:
+                del self._stores[old]
+            self._stores[fingerprint] = vectorstore
+            self._fingerprints[vectorstore] = fingerprint
+            return vectorstore
+
+    def get_or_load(self, fingerprint: str, loader):
+        """등록된 벡터스토어를 반환하고, 없으면 loader()로 만들어 등록합니다 (None이면 등록하지 않음)."""
+        vs = self.get(fingerprint)
+        if vs is not None:
+            return vs
+        with self._lock:
+            load_lock = self._load_locks.setdefault(fingerprint, threading.Lock())
+        with load_lock:
+            vs = self.get(fingerprint)
+            if vs is None:
+                vs = loader()
+                if vs is not None:
+                    vs = self.put(fingerprint, vs)
+        with self._lock:
+            self._load_locks.pop(fingerprint, None)
+        return vs
+
+    def fingerprint_of(self, vectorstore) -> Optional[str]:
+        with self._lock:
+            return self._fingerprints.get(vectorstore)
+
+    def lease(self, vectorstore) -> "_CorpusLease":
+        """세션이 벡터스토어를 쓰는 동안 들고 있을 임대 객체. 등록되지 않은 벡터스토어는 지문을 계산해 등록합니다."""
+        fingerprint = self.fingerprint_of(vectorstore)
+        if fingerprint is None:
+            fingerprint = vectorstore_fingerprint(vectorstore)
+            self.put(fingerprint, vectorstore)
+        with self._lock:
+            self._sessions[fingerprint] = self._sessions.get(fingerprint, 0) + 1
+        return _CorpusLease(self, fingerprint)
+
+    def _release(self, fingerprint: str) -> None:
+        with self._lock:
+            n = self._sessions.get(fingerprint, 0) - 1
+            if n > 0:
+                self._sessions[fingerprint] = n
+            else:
+                self._sessions.pop(fingerprint, None)
+
+    def stats(self) -> dict:
+        """{지문: 사용 중인 세션 수} (메모리에 남아 있는 코퍼스만)."""
+        with self._lock:
+            return {fp: self._sessions.get(fp, 0) for fp in self._stores.keys()}
+
+class _CorpusLease:
+    """세션 상태에 보관하는 임대 객체. 가비지 컬렉션되면 레지스트리의 세션 수를 줄입니다."""
+    def __init__(self, registry: VectorStoreRegistry, fingerprint: str):
+        self.fingerprint = fingerprint
+        weakref.finalize(self, registry._release, fingerprint)
+
+_VS_REGISTRY = VectorStoreRegistry()
+
+def get_vectorstore_registry() -> VectorStoreRegistry:
+    """프로세스 공용 벡터스토어 레지스트리 (모든 Streamlit 세션이 공유)."""
+    return _VS_REGISTRY
+
+# 세션에서 인덱스를 참조하는 값 (페이지 1~8의 Q&A 체인과 카테고리 검색기)
+_SESSION_INDEX_KEYS = ("qa_chain", "retriever", "qa_category")
+
+def attach_session_vectorstore(session_state, vectorstore) -> None:
+    """세션이 공유 벡터스토어를 참조하도록 연결합니다 (이전 코퍼스의 임대는 해제).
+
+    이전 인덱스에 묶인 Q&A 체인/검색기는 지워 페이지가 새 인덱스로 다시 만들게 합니다.
+    카테고리별 퀴즈 컨텍스트가 아직 없으면 백그라운드에서 미리 계산합니다.
+    """
+    for key in _SESSION_INDEX_KEYS:
+        session_state.pop(key, None)
+    session_state["vectorstore"] = vectorstore
+    session_state["vectorstore_lease"] = _VS_REGISTRY.lease(vectorstore)
+    precompute_category_contexts(vectorstore, background=True)
+
+# 카테고리별 퀴즈 컨텍스트: 인덱스 버전마다 카테고리당 한 번만 검색해 두고 문제 생성/채점에서 그대로 씀
+QUIZ_CATEGORIES = ("포토리소그래피", "식각", "산화", "확산", "이온주입", "증착", "금속배선", "평탄화")
+# 카테고리 키워드: 앞의 다섯 개는 컨텍스트 검색 질의에, 전체는 인제스트 때 청크 태깅에 씀 (영문은 단어 경계로 매칭)
+_CATEGORY_KEYWORDS = {
+    "포토리소그래피": ["photolithography", "감광제", "노광", "현상", "마스크", "포토리소그래피", "리소그래피",
+                "lithography", "photoresist", "exposure", "레티클", "reticle", "euv", "해상도", "스테퍼"],
+    "식각": ["etching", "건식", "습식", "플라즈마", "선택비", "식각", "etch", "rie", "이방성", "등방성",
+           "selectivity", "plasma", "에천트"],
+    "산화": ["oxidation", "열산화", "산화막", "SiO2", "산화", "oxide", "게이트 산화", "deal-grove", "건식 산화",
+           "습식 산화"],
+    "확산": ["diffusion", "도펀트", "확산 계수", "열처리", "확산", "dopant", "fick", "접합 깊이", "프리디포지션",
+           "드라이브인"],
+    "이온주입": ["ion implantation", "도즈", "에너지", "어닐링", "이온주입", "이온 주입", "implant", "dose",
+             "anneal", "채널링", "channeling", "투사 거리"],
+    "증착": ["deposition", "CVD", "PVD", "ALD", "박막", "증착", "sputtering", "스퍼터링", "에피택시", "epitaxy",
+           "스텝 커버리지"],
+    "금속배선": ["metallization", "interconnect", "구리", "배선", "다마신", "금속배선", "damascene", "copper",
+             "알루미늄", "aluminum", "비아", "via hole", "via fill", "through-silicon via", "tsv", "전자이동",
+             "electromigration", "배리어"],
+    "평탄화": ["CMP", "planarization", "슬러리", "연마", "평탄화", "slurry", "polishing", "디싱", "dishing",
+            "에로전", "erosion"],
+}
+# 키워드를 바꾸면 올림 (인제스트 캐시에서 읽은 청크도 규칙 버전이 다르면 다시 태깅)
+_CATEGORY_RULES_VERSION = 2
+# 청크를 태깅하는 최소 키워드 등장 수와 (최고 점수 대비) 상대 비율
+CATEGORY_TAG_MIN_HITS = int(os.getenv("CATEGORY_TAG_MIN_HITS", "2"))
+CATEGORY_TAG_RATIO = 0.5
+
+def _keyword_pattern(words: list[str]) -> "re.Pattern":
+    parts = [rf"\b{re.escape(w.lower())}\b" if w.isascii() else re.escape(w.lower()) for w in words]
+    return re.compile("|".join(sorted(parts, key=len, reverse=True)))
+
+_CATEGORY_PATTERNS = {c: _keyword_pattern(words) for c, words in _CATEGORY_KEYWORDS.items()}
+
+def tag_categories(text: str) -> list[str]:
+    """청크 텍스트가 다루는 공정 카테고리 (키워드 등장 수 기준, QUIZ_CATEGORIES 순서).
+
+    CATEGORY_TAG_MIN_HITS번 이상 나오고 최고 점수의 CATEGORY_TAG_RATIO배 이상인 카테고리만 남깁니다.
+    """
+    low = (text or "").lower()
+    scores = {c: len(p.findall(low)) for c, p in _CATEGORY_PATTERNS.items()}
+    best = max(scores.values(), default=0)
+    if best < CATEGORY_TAG_MIN_HITS:
+        return []
+    return [c for c in QUIZ_CATEGORIES if scores[c] >= max(CATEGORY_TAG_MIN_HITS, best * CATEGORY_TAG_RATIO)]
+
+CATEGORY_CONTEXT_K = 6
+CATEGORY_CONTEXT_MAX_CHARS = 6000
+_CONTEXT_DIGESTS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 벡터스토어 → 버전/카테고리별 컨텍스트
+_CONTEXT_DIGESTS_LOCK = threading.Lock()
+
+def category_query(category: str) -> str:
+    """카테고리 컨텍스트 검색 질의 (카테고리명 + 영문/핵심 용어)."""
+    return " ".join([category, *_CATEGORY_KEYWORDS.get(category, [])[:5], "핵심 개념 요약"])
+
+def _index_version(vectorstore) -> tuple:
+    # 추가/삭제는 사본에서 하고 새 지문으로 등록되지만, 제자리 수정도 벡터 수로 잡아냄
+    return _VS_REGISTRY.fingerprint_of(vectorstore) or "", int(vectorstore.index.ntotal)
+
+_SOURCES: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 벡터스토어 → (버전, 출처 목록)
+_SOURCES_LOCK = threading.Lock()
+
+def cached_vectorstore_sources(vectorstore) -> list[str]:
+    """vectorstore_sources를 인덱스 버전마다 한 번만 계산합니다 (화면을 다시 그릴 때마다 부르는 용도).
+
+    레지스트리 지문의 저장본이 있으면 save_vectorstore가 meta.json에 적어 둔 출처 목록을 읽어,
+    mmap 인덱스도 청크를 디코딩하지 않습니다.
+    """
+    version = _index_version(vectorstore)
+    with _SOURCES_LOCK:
+        entry = _SOURCES.get(vectorstore)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    sources = None
+    if version[0]:
+        try:
+            with open(os.path.join(VECTORSTORE_DIR, version[0], "meta.json"), encoding="utf-8") as f:
+                sources = json.load(f).get("sources") or None
+        except (OSError, ValueError):
+            sources = None
+    if sources is None:
+        sources = vectorstore_sources(vectorstore)
+    with _SOURCES_LOCK:
+        _SOURCES[vectorstore] = (version, sources)
+    return sources
+
+def _join_context(docs: list) -> str:
+    return "\n\n".join(d.page_content for d in docs)[:CATEGORY_CONTEXT_MAX_CHARS]
+
+def _retrieve_context(vectorstore, query: str, k: int, category: Optional[str] = None) -> str:
+    return _join_context(retrieve(vectorstore, query, k, category))
+
+def precompute_category_contexts(vectorstore, background: bool = False) -> dict:
+    """QUIZ_CATEGORIES 각각의 컨텍스트(그 카테고리로 태깅된 청크 중 상위 CATEGORY_CONTEXT_K개)를 계산해
+    인덱스 버전에 묶어 둡니다.
+
+    같은 버전이 이미 계산됐거나 계산 중이면 아무것도 하지 않습니다. background=True면 데몬 스레드에서 계산합니다.
+    검색에 실패하면 비워 두어 category_context가 카테고리별로 다시 시도합니다.
+    반환값은 {"version", "digests"(카테고리 → 텍스트), "ready"(threading.Event)}.
+    """
+    version = _index_version(vectorstore)
+    with _CONTEXT_DIGESTS_LOCK:
+        entry = _CONTEXT_DIGESTS.get(vectorstore)
+        if entry is not None and entry["version"] == version:
+            return entry
+        entry = {"version": version, "digests": {}, "ready": threading.Event()}
+        _CONTEXT_DIGESTS[vectorstore] = entry
+
+    def _fill():
+        # 여덟 카테고리 질의를 한 번의 임베딩 배치로 검색
+        try:
+            found = search_many(vectorstore, [category_query(c) for c in QUIZ_CATEGORIES], CATEGORY_CONTEXT_K,
+                                list(QUIZ_CATEGORIES))
+            for category, docs in zip(QUIZ_CATEGORIES, found):
+                entry["digests"][category] = _join_context(docs)
+        except Exception:
+            pass
+        finally:
+            entry["ready"].set()
+
+    if background:
+        threading.Thread(target=_fill, name="category-contexts", daemon=True).start()
+    else:
+        _fill()
+    return entry
+
+def category_context(vectorstore, category: str, k: int = CATEGORY_CONTEXT_K, wait: float = 30.0) -> str:
+    """카테고리 컨텍스트. 현재 인덱스 버전의 미리 계산된 값이 있으면 검색 없이 바로 돌려줍니다.
+
+    계산 중이면 최대 wait초 기다리고, k가 기본값과 다르거나 값이 없으면 직접 검색합니다 (기본 k면 결과를 메모).
+    """
+    if k != CATEGORY_CONTEXT_K:
+        return _retrieve_context(vectorstore, category_query(category), k, category)
+    entry = precompute_category_contexts(vectorstore, background=True)
+    entry["ready"].wait(wait)
+    text = entry["digests"].get(category)
+    if text is None:
+        text = _retrieve_context(vectorstore, category_query(category), k, category)
+        entry["digests"][category] = text
+    return text
+
+def clone_vectorstore(vectorstore):
+    """수정용 사본. FAISS 인덱스와 id 매핑은 복사하고, Document 객체는 원본과 공유합니다."""
+    if isinstance(vectorstore.docstore, MmapDocstore):
+        # mmap 인덱스는 메모리로 읽어 들인 사본을 만듦
+        index = faiss.deserialize_index(faiss.serialize_index(vectorstore.index))
+    else:
+        index = faiss.clone_index(vectorstore.index)
+    clone = FAISS(
+        embedding_function=vectorstore.embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(_iter_docstore(vectorstore))),
+        index_to_docstore_id=dict(vectorstore.index_to_docstore_id),
+        distance_strategy=vectorstore.distance_strategy,
+    )
+    _copy_minhash(vectorstore, clone)
+    with _CATEGORY_IDS_LOCK:
+        masks = _CATEGORY_MASKS.get(vectorstore)
+        if masks is not None:
+            _CATEGORY_MASKS[clone] = masks  # 제자리 수정하지 않으므로 공유
+    return clone
+
+# 카테고리 파티션 검색: 인제스트 때 붙인 metadata["categories"]로 카테고리별 FAISS id 목록을 만들고
+# IDSelector로 그 id들만 탐색 (Flat은 나머지 벡터의 거리 계산을 건너뛰고, HNSW/IVF는 후보에서 제외)
+_CATEGORY_IDS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 벡터스토어 → 버전/카테고리별 id 배열
+_CATEGORY_IDS_LOCK = threading.Lock()
+# FAISS 위치별 카테고리 비트마스크 (비트 i = QUIZ_CATEGORIES[i]). 인제스트 때 채우고 인덱스 옆(categories.npy)에
+# 저장하므로, 불러온 인덱스(mmap 포함)는 category_ids를 위해 docstore를 읽지 않음
+_CATEGORY_MASKS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 벡터스토어 → uint8 배열
+
+def _category_mask(categories: Iterable[str]) -> int:
+    return sum(1 << QUIZ_CATEGORIES.index(c) for c in set(categories) if c in QUIZ_CATEGORIES)
+
+def _append_category_masks(vectorstore, base: int, masks: list[int]) -> None:
+    """위치 base부터 새로 추가된 청크들의 마스크를 붙입니다. 앞부분 마스크가 없으면 (나중에 docstore로 다시 만듦) 버림."""
+    with _CATEGORY_IDS_LOCK:
+        current = _CATEGORY_MASKS.get(vectorstore)
+        if current is None and base == 0:
+            current = np.zeros(0, dtype=np.uint8)
+        if current is None or len(current) != base:
+            _CATEGORY_MASKS.pop(vectorstore, None)
+            return
+        _CATEGORY_MASKS[vectorstore] = np.concatenate([current, np.asarray(masks, dtype=np.uint8)])
+
+def _keep_category_masks(vectorstore, keep: list[int]) -> None:
+    """삭제 뒤 남은 위치(원래 순서)만 마스크에 남깁니다."""
+    with _CATEGORY_IDS_LOCK:
+        current = _CATEGORY_MASKS.get(vectorstore)
+        if current is None:
+            return
+        if keep and keep[-1] >= len(current):
+            del _CATEGORY_MASKS[vectorstore]
+            return
+        _CATEGORY_MASKS[vectorstore] = current[keep]
+
+def _category_masks(vectorstore) -> np.ndarray:
+    """위치별 카테고리 마스크. 없거나 벡터 수와 맞지 않으면 docstore를 훑어 다시 만듭니다
+    (태그가 없는, 이 기능 이전에 만든 청크는 tag_categories로 태깅)."""
+    n = int(vectorstore.index.ntotal)
+    with _CATEGORY_IDS_LOCK:
+        masks = _CATEGORY_MASKS.get(vectorstore)
+    if masks is not None and len(masks) == n:
+        return masks
+    masks = np.zeros(n, dtype=np.uint8)
+    for pos, _id in vectorstore.index_to_docstore_id.items():
+        doc = vectorstore.docstore.search(_id)
+        if isinstance(doc, Document) and pos < n:
+            cats = doc.metadata.get("categories")
+            masks[pos] = _category_mask(cats if cats is not None else tag_categories(doc.page_content))
+    with _CATEGORY_IDS_LOCK:
+        _CATEGORY_MASKS[vectorstore] = masks
+    return masks
+
+def _save_category_masks(vectorstore, path: str) -> None:
+    np.save(os.path.join(path, "categories.npy"), _category_masks(vectorstore))
+
+def _load_category_masks(vectorstore, path: str) -> None:
+    try:
+        masks = np.load(os.path.join(path, "categories.npy"))
+    except Exception:
+        return
+    if len(masks) == vectorstore.index.ntotal:
+        with _CATEGORY_IDS_LOCK:
+            _CATEGORY_MASKS[vectorstore] = masks
+
+def category_ids(vectorstore, category: str) -> Optional[np.ndarray]:
+    """category로 태깅된 청크의 FAISS 위치(int64 배열). 없으면 None.
+
+    인덱스 버전마다 한 번 위치별 카테고리 마스크(_category_masks)에서 모든 카테고리의 목록을 만듭니다.
+    """
+    version = _index_version(vectorstore)
+    with _CATEGORY_IDS_LOCK:
+        entry = _CATEGORY_IDS.get(vectorstore)
+    if entry is None or entry["version"] != version:
+        masks = _category_masks(vectorstore)
+        ids = {}
+        for bit, c in enumerate(QUIZ_CATEGORIES):
+            found = np.flatnonzero(masks & (1 << bit)).astype(np.int64)
+            if len(found):
+                ids[c] = found
+        entry = {"version": version, "ids": ids}
+        with _CATEGORY_IDS_LOCK:
+            _CATEGORY_IDS[vectorstore] = entry
+    return entry["ids"].get(category)
+
+def _search_params(index, ef_search: Optional[int] = None, nprobe: Optional[int] = None, selector=None):
+    """검색 호출마다 넘기는 SearchParameters: HNSW efSearch / IVF nprobe (생략하면 FAISS_EF_SEARCH / FAISS_NPROBE)와
+    선택적 IDSelector. 여러 세션이 공유하는 인덱스 자체의 값은 바꾸지 않습니다.
+    SWIG 객체 수명을 위해 (바깥 파라미터, 안쪽 파라미터) 둘 다 돌려줍니다."""
+    core = _core_index(index)
+    if isinstance(core, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = ef_search or FAISS_EF_SEARCH
+    elif isinstance(core, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = min(nprobe or FAISS_NPROBE, core.nlist)
+    else:
+        params = faiss.SearchParameters()
+    if selector is not None:
+        params.sel = selector
+    if isinstance(index, faiss.IndexPreTransform):
+        outer = faiss.SearchParametersPreTransform()
+        outer.index_params = params
+        return outer, params
+    return params, params
+
+def _dense_positions_many(vectorstore, vectors: np.ndarray, k: int, ids: Optional[np.ndarray] = None,
+                          ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> list:
+    """질의 벡터 행렬(n×d)을 한 번의 FAISS 검색으로 처리해 질의별 가까운 위치 k개 리스트를 돌려줍니다.
+    ids를 주면 그 위치들만 탐색합니다. ef_search/nprobe는 이 검색에만 적용됩니다 (_search_params)."""
+    if len(vectors) == 0:
+        return []
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if getattr(vectorstore, "_normalize_L2", False):
+        faiss.normalize_L2(vectors)
+    index = vectorstore.index
+    selector = faiss.IDSelectorBatch(ids) if ids is not None else None
+    params, _inner = _search_params(index, ef_search, nprobe, selector)
+    limit = index.ntotal if ids is None else len(ids)
+    _, found = index.search(vectors, max(1, min(k, limit)), params=params)
+    return [[int(pos) for pos in row if pos >= 0] for row in found]
+
+def _docs_at(vectorstore, positions: Iterable[int]) -> list:
+    docs = []
+    for pos in positions:
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[pos])
+        if isinstance(doc, Document):
+            docs.append(doc)
+    return docs
+
+def category_search(vectorstore, query: str, k: int = 4, category: Optional[str] = None) -> list:
+    """category 파티션 안에서만 유사도 검색한 Document 리스트 (가까운 순).
+
+    category가 없거나 그 카테고리로 태깅된 청크가 없으면 전체 코퍼스를 검색합니다.
+    """
+    return search_many(vectorstore, [query], k, category, mode="dense")[0]
+
+# BM25 역색인: 벡터 검색이 놓치는 정확한 용어(SC-1, Deal–Grove, LER/LWR, k1 …)를 잡아 RRF로 합침
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").strip().lower()  # hybrid | dense
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+_COMPOUND_TERM = re.compile(r"[0-9a-z]+(?:[-‐–—/][0-9a-z]+)+")
+_COMPOUND_SEP = re.compile(r"[-‐–—/]")
+
+def _bm25_tokens(text: str) -> list[str]:
+    """_normalize_text 토큰 + 하이픈/슬래시 복합어를 붙인 토큰(sc1, dealgrove, lerlwr) + 세 글자 이상 한글 토큰의
+    글자 bigram(조사가 붙은 형태도 어간과 겹치도록)."""
+    low = unicodedata.normalize("NFKC", text or "").lower()
+    toks = _normalize_text(low)
+    toks += [_COMPOUND_SEP.sub("", m) for m in _COMPOUND_TERM.findall(low)]
+    toks += [t[i:i + 2] for t in toks if len(t) >= 3 and "가" <= t[0] <= "힣" for i in range(len(t) - 1)]
+    return toks
+
+class BM25Index:
+    """CSR 형태의 BM25 역색인 (용어 → 문서 위치/가중치).
+
+    문서 위치는 FAISS 위치와 같습니다. 용어별 BM25 가중치(idf × 정규화 tf)를 빌드 때 미리 계산해 두므로
+    검색은 질의 용어의 posting 구간을 점수 배열에 더하고 상위 k개를 고르는 NumPy 연산뿐입니다.
+    """
+    def __init__(self, vocab: dict, indptr: np.ndarray, postings: np.ndarray, weights: np.ndarray, n_docs: int):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.postings = postings
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts: Iterable[Tuple[int, str]], n_docs: int, k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        vocab: dict = {}
+        tid_parts, pos_parts, tf_parts = [], [], []  # 문서별 (용어 id, tf) 배열
+        doc_len = np.zeros(n_docs, dtype=np.float32)
+        for pos, text in texts:
+            toks = _bm25_tokens(text)
+            doc_len[pos] = len(toks)
+            if not toks:
+                continue
+            ids = np.fromiter((vocab.setdefault(t, len(vocab)) for t in toks), dtype=np.int32, count=len(toks))
+            uniq, tf = np.unique(ids, return_counts=True)
+            tid_parts.append(uniq)
+            tf_parts.append(tf.astype(np.float32))
+            pos_parts.append(np.full(len(uniq), pos, dtype=np.int32))
+        if not tid_parts:
+            return cls(vocab, np.zeros(len(vocab) + 1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                       np.zeros(0, dtype=np.float32), n_docs)
+        tids, positions, tf = np.concatenate(tid_parts), np.concatenate(pos_parts), np.concatenate(tf_parts)
+        order = np.lexsort((positions, tids))
+        tids, positions, tf = tids[order], positions[order], tf[order]
+        df = np.bincount(tids, minlength=len(vocab)).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avgdl = float(doc_len.mean()) if n_docs else 1.0
+        norm = k1 * (1 - b + b * doc_len[positions] / max(avgdl, 1e-6))
+        weights = (idf[tids] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(df.astype(np.int64))
+        return cls(vocab, indptr, positions, weights, n_docs)
+
+    def search(self, query: str, k: int, ids: Optional[np.ndarray] = None) -> list[int]:
+        """BM25 점수 상위 k개 위치 (점수 순). ids를 주면 그 위치들 안에서만."""
+        terms = {self.vocab[t] for t in _bm25_tokens(query) if t in self.vocab}
+        if not terms or k <= 0:
+            return []
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for tid in terms:
+            lo, hi = self.indptr[tid], self.indptr[tid + 1]
+            scores[self.postings[lo:hi]] += self.weights[lo:hi]
+        if ids is not None:
+            mask = np.zeros(self.n_docs, dtype=bool)
+            mask[ids] = True
+            scores[~mask] = 0.0
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        return [int(p) for p in hits[np.argsort(-scores[hits], kind="stable")]]
+
+    def save(self, path: str) -> None:
+        np.savez(os.path.join(path, "bm25.npz"), indptr=self.indptr, postings=self.postings,
+                 weights=self.weights, n_docs=np.int64(self.n_docs))
+        with open(os.path.join(path, "bm25_vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(sorted(self.vocab, key=self.vocab.get), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["BM25Index"]:
+        try:
+            with open(os.path.join(path, "bm25_vocab.json"), encoding="utf-8") as f:
+                terms = json.load(f)
+            data = np.load(os.path.join(path, "bm25.npz"))
+            return cls({t: i for i, t in enumerate(terms)}, data["indptr"], data["postings"], data["weights"],
+                       int(data["n_docs"]))
+        except Exception:
+            return None
+
+_BM25_INDEXES: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 벡터스토어 → 버전/BM25Index
+_BM25_LOCK = threading.Lock()
+
+def get_bm25_index(vectorstore, fingerprint: Optional[str] = None) -> BM25Index:
+    """벡터스토어의 BM25 역색인 (인덱스 버전마다 한 번 빌드). 인제스트 후 저장할 때 만들어 함께 저장되고,
+    저장된 인덱스를 불러오면 파일에서 읽습니다. fingerprint는 아직 레지스트리에 등록되기 전에 부를 때 지정합니다."""
+    version = (fingerprint or _VS_REGISTRY.fingerprint_of(vectorstore) or "", int(vectorstore.index.ntotal))
+    with _BM25_LOCK:
+        entry = _BM25_INDEXES.get(vectorstore)
+        if entry is None or entry["version"] != version:
+            texts = ((pos, doc.page_content) for pos, doc in
+                     ((p, vectorstore.docstore.search(_id)) for p, _id in vectorstore.index_to_docstore_id.items())
+                     if isinstance(doc, Document))
+            entry = {"version": version, "index": BM25Index.build(texts, int(vectorstore.index.ntotal))}
+            _BM25_INDEXES[vectorstore] = entry
+        return entry["index"]
+
+def _attach_bm25_index(vectorstore, fingerprint: str, index: BM25Index) -> None:
+    with _BM25_LOCK:
+        _BM25_INDEXES[vectorstore] = {"version": (fingerprint, int(vectorstore.index.ntotal)), "index": index}
+
+def _rrf(rankings: list, k: int) -> list[int]:
+    """reciprocal-rank fusion: 위치별 Σ 1/(RRF_K + 순위) 상위 k개."""
+    fused: dict = {}
+    for positions in rankings:
+        for rank, pos in enumerate(positions):
+            fused[pos] = fused.get(pos, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(fused, key=lambda p: -fused[p])[:k]
+
+def _embed_queries(embedding, queries: list[str]) -> list:
+    # embed_queries가 있으면 (CachedEmbeddings, HashingEmbeddings) 한 번의 배치 요청으로
+    if hasattr(embedding, "embed_queries"):
+        return embedding.embed_queries(queries)
+    return [embedding.embed_query(q) for q in queries]
+
+def search_many(vectorstore, queries: list[str], k: int = 4, category=None, mode: Optional[str] = None,
+                fetch_k: Optional[int] = None, ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> list:
+    """여러 질의를 한꺼번에 검색해 질의별 Document 리스트를 입력 순서대로 돌려줍니다.
+
+    질의 임베딩은 한 번의 배치 요청(캐시 적중분 제외)으로 만들고, FAISS 검색은 질의 행렬 하나로 처리합니다.
+    category는 모든 질의에 같은 카테고리(str) 또는 질의별 리스트이며, 카테고리마다 파티션 검색을 한 번씩 합니다.
+    mode(기본 RETRIEVAL_MODE)가 "hybrid"면 질의별 BM25 결과와 RRF로 합칩니다 (fetch_k 기본 max(4k, 20)).
+    ef_search / nprobe는 이번 검색의 HNSW / IVF 탐색 폭입니다 (생략하면 FAISS_EF_SEARCH / FAISS_NPROBE).
+    """
+    queries = list(queries)
+    if not queries:
+        return []
+    if not HAS_FAISS:
+        return [vectorstore.similarity_search(q, k=k) for q in queries]
+    cats = list(category) if isinstance(category, (list, tuple)) else [category] * len(queries)
+    hybrid = (mode or RETRIEVAL_MODE) == "hybrid"
+    fetch_k = (fetch_k or max(4 * k, 20)) if hybrid else k
+    vectors = np.asarray(_embed_queries(vectorstore.embeddings, queries), dtype=np.float32)
+    dense: list = [None] * len(queries)
+    for cat in dict.fromkeys(cats):
+        rows = [i for i, c in enumerate(cats) if c == cat]
+        ids = category_ids(vectorstore, cat) if cat else None
+        found = _dense_positions_many(vectorstore, vectors[rows], fetch_k, ids, ef_search, nprobe)
+        for i, positions in zip(rows, found):
+            dense[i] = positions
+    if hybrid:
+        bm25 = get_bm25_index(vectorstore)
+        ranked = [_rrf([dense[i], bm25.search(q, fetch_k, category_ids(vectorstore, cats[i]) if cats[i] else None)], k)
+                  for i, q in enumerate(queries)]
+    else:
+        ranked = [positions[:k] for positions in dense]
+    return [_docs_at(vectorstore, positions) for positions in ranked]
+
+def hybrid_search(vectorstore, query: str, k: int = 4, category: Optional[str] = None,
+                  fetch_k: Optional[int] = None) -> list:
+    """BM25와 벡터 검색 결과를 reciprocal-rank fusion(Σ 1/(RRF_K + 순위))으로 합친 상위 k개 Document.
+
+    두 검색 모두 fetch_k개(기본 max(4k, 20))씩 가져오고, category를 주면 그 파티션 안에서만 찾습니다.
+    """
+    return search_many(vectorstore, [query], k, category, mode="hybrid", fetch_k=fetch_k)[0]
+
+def retrieve(vectorstore, query: str, k: int = 4, category: Optional[str] = None,
+             mode: Optional[str] = None) -> list:
+    """RETRIEVAL_MODE(기본 hybrid)에 따라 hybrid_search 또는 category_search."""
+    return search_many(vectorstore, [query], k, category, mode=mode)[0]
+
+class CategoryRetriever(BaseRetriever):
+    """페이지별 검색기: 그 페이지 카테고리 파티션만 검색합니다 (RETRIEVAL_MODE에 따라 하이브리드/벡터)."""
+    vectorstore: Any
+    category: Optional[str] = None
+    k: int = 4
+    mode: Optional[str] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> list:
+        return retrieve(self.vectorstore, query, self.k, self.category, self.mode)
+
+def category_retriever(vectorstore, category: Optional[str], k: int = 4, mode: Optional[str] = None) -> "CategoryRetriever":
+    return CategoryRetriever(vectorstore=vectorstore, category=category, k=k, mode=mode)
+
+def hybrid_retriever(vectorstore, k: int = 4, category: Optional[str] = None) -> "CategoryRetriever":
+    """BM25 + 벡터 RRF 검색기 (category 없으면 전체 코퍼스)."""
+    return CategoryRetriever(vectorstore=vectorstore, category=category, k=k, mode="hybrid")
+
 # PDF→VectorStore
-def build_vectorstore_from_pdfs(files: List, embed_backend: str = "openai"):
-    """업로드된 PDF들로 FAISS 인덱스 생성 (필요 시 사용)."""
+def build_vectorstore_from_pdfs(files: List, embed_backend: str = "openai", workers: Optional[int] = None,
+                                progress=None, cancel=None, embedding=None):
+    """업로드된 PDF들로 FAISS 인덱스 생성 (필요 시 사용).
+
+    같은 코퍼스 지문의 인덱스가 VECTORSTORE_DIR에 있으면 그대로 불러옵니다.
+    없으면 파일 단위로 INGEST_CACHE_DIR 캐시를 확인해, 이미 처리한 PDF는 파싱·임베딩 API 호출 없이
+    저장된 청크/벡터를 그대로 씁니다. 캐시 미스 파일만 파싱·분할·임베딩 후 캐시에 기록하고,
+    완성된 인덱스는 지문 디렉터리에 저장합니다. 인제스트는 스트리밍으로 진행됩니다 (_run_ingest 참고).
+    인제스트가 끝나면 벡터 수에 맞춰 Flat / HNSW / IVF-PQ 인덱스로 바꿉니다 (adapt_vectorstore_index 참고).
+    다른 세션이 이미 같은 코퍼스를 불러왔다면 새로 만들지 않고 그 벡터스토어를 공유합니다 (VectorStoreRegistry).
+
+    Args:
+        files: 업로드된 PDF 파일 객체 리스트
+        embed_backend: "openai" | "gemini" | "local"
+        workers: PDF 파싱 워커 수 (load_pdf_documents 참고)
+        progress: 진행 콜백 fn(stats) — 윈도마다 처리 청크 수, chunks/sec, 진행률(fraction) 등 전달
+        cancel: 설정되면 인제스트를 멈추고 IngestCancelled를 올리는 threading.Event
+        embedding: 임베딩 객체를 직접 지정 (기본은 get_embedding(embed_backend)). 벤치마크용이며,
+            캐시 키/지문은 embed_backend 이름으로 계산되므로 실제 백엔드와 다른 이름을 줘야 합니다.
+            인덱스 변환(adapt_vectorstore_index)까지 끝나면 index_s에 변환 시간을 더해 progress를 한 번 더 호출합니다.
+    """
     if not HAS_VS:
         raise RuntimeError("langchain-community 등 벡터스토어 의존성 설치 필요")
-    docs = []
-    for f in files:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(f.read()); tmp_path = tmp.name
+    if embedding is None:
+        embedding = get_embedding(embed_backend)
+    payloads = _read_uploads(files)
+    keys = [_ingest_cache_key(data, embed_backend) for _, data in payloads]
+    # 내용이 같은 파일은 처음 것만 인제스트 (청크 id가 파일 키로 만들어지므로 중복되면 FAISS가 거부)
+    first = {}
+    for i, key in enumerate(keys):
+        first.setdefault(key, i)
+    payloads, keys = [payloads[i] for i in first.values()], list(first)
+    fingerprint = corpus_fingerprint(keys)
+
+    def _load_or_ingest():
+        vs = load_vectorstore(fingerprint, embed_backend)
+        if vs is not None:
+            return vs
+        last: dict = {}
+
+        def _progress(stats):
+            last.update(stats)
+            if progress is not None:
+                progress(stats)
+
+        vs = _run_ingest(None, payloads, keys, embedding, workers=workers, progress=_progress, cancel=cancel)
+        if vs is None:
+            raise RuntimeError("PDF에서 추출한 텍스트가 없습니다.")
+        t_adapt = time.perf_counter()
+        adapt_vectorstore_index(vs)
+        if progress is not None and last:
+            last["index_s"] = last.get("index_s", 0.0) + time.perf_counter() - t_adapt
+            progress(dict(last))
         try:
-            loader = PyPDFLoader(tmp_path)
-            docs.extend(loader.load())
-        finally:
-            try: os.remove(tmp_path)
-            except Exception: pass
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    splits = splitter.split_documents(docs)
-    # 기본 OpenAI 임베딩 사용
-    embedding = OpenAIEmbeddings(openai_api_key=os.environ.get("OPENAI_API_KEY", ""))
-    return FAISS.from_documents(splits, embedding)
+            save_vectorstore(vs, fingerprint, embed_backend, sources=vectorstore_sources(vs))
+        except Exception:
+            pass
+        return vs
+
+    return _VS_REGISTRY.get_or_load(fingerprint, _load_or_ingest)
+
+# 증분 추가/삭제 (이미 인덱싱된 청크는 다시 임베딩하지 않음)
+def vectorstore_backend(vectorstore) -> Optional[str]:
+    """인덱스를 만든 임베딩 백엔드 이름. 공유 임베딩 객체(get_embedding)로 알아내며, 모르면 None."""
+    emb = vectorstore.embeddings
+    with _EMBEDDINGS_LOCK:
+        for (backend, _model), shared in _EMBEDDINGS.items():
+            if shared is emb:
+                return backend
+    if isinstance(emb, CachedEmbeddings):
+        return emb.backend
+    if isinstance(emb, HashingEmbeddings):
+        return "local"
+    return None
+
+def _store_backend(vectorstore, embed_backend: Optional[str] = None) -> str:
+    """증분 수정에 쓸 백엔드. 인덱스의 백엔드를 따르며, 지정한 embed_backend가 다르면 RuntimeError."""
+    backend = vectorstore_backend(vectorstore)
+    if backend is None:
+        raise RuntimeError("인덱스의 임베딩 백엔드를 알 수 없습니다.")
+    if embed_backend and embed_backend.lower() != backend:
+        raise RuntimeError(f"이 인덱스는 '{backend}' 임베딩으로 만들어졌습니다. "
+                           f"'{embed_backend}' 대신 '{backend}' 백엔드를 선택하세요.")
+    return backend
+
+def add_pdfs_to_vectorstore(vectorstore, files: List, embed_backend: Optional[str] = None,
+                            workers: Optional[int] = None, progress=None, cancel=None) -> list[str]:
+    """새 PDF들의 청크만 기존 FAISS 인덱스에 추가하고, 추가된 파일명 리스트를 반환합니다.
+
+    이미 같은 내용(파일 키)이 인덱스에 있는 파일은 건너뜁니다. 변경된 인덱스는 새 지문으로 저장됩니다.
+    임베딩 백엔드는 인덱스를 만든 백엔드를 쓰며, embed_backend가 그와 다르면 RuntimeError를 올립니다.
+    vectorstore를 제자리에서 바꾸므로, 여러 세션이 공유하는 인덱스라면 clone_vectorstore() 사본을 넘기세요.
+    결과 코퍼스가 이미 레지스트리에 있으면 그 인스턴스를 써야 하므로, 세션에 붙일 벡터스토어가 필요하면
+    submit_add_job을 쓰세요.
+    """
+    return _add_pdfs(vectorstore, files, embed_backend, workers, progress, cancel)[1]
+
+def _add_pdfs(vectorstore, files: List, embed_backend: Optional[str], workers: Optional[int] = None,
+              progress=None, cancel=None) -> tuple:
+    """add_pdfs_to_vectorstore 본체. (레지스트리에 등록된 벡터스토어, 추가된 파일명 리스트)"""
+    _ensure_writable(vectorstore)
+    embed_backend = _store_backend(vectorstore, embed_backend)
+    payloads = _read_uploads(files)
+    keys = [_ingest_cache_key(data, embed_backend) for _, data in payloads]
+    indexed = {doc.metadata.get("file_key", "") for _, doc in _iter_docstore(vectorstore)}
+    new = [i for i, k in enumerate(keys) if k not in indexed and k not in keys[:i]]
+    if not new:
+        return vectorstore, []
+    _run_ingest(vectorstore, [payloads[i] for i in new], [keys[i] for i in new], vectorstore.embeddings,
+                workers=workers, progress=progress, cancel=cancel)
+    registered = _persist_after_update(vectorstore, embed_backend, previous=corpus_fingerprint(indexed))
+    return registered, [payloads[i][0] for i in new]
+
+def remove_source_from_vectorstore(vectorstore, source: str, embed_backend: Optional[str] = None) -> int:
+    """출처(파일명)가 source인 청크를 인덱스에서 삭제하고 삭제한 청크 수를 반환합니다 (제자리 수정, 위 참고)."""
+    return remove_sources_from_vectorstore(vectorstore, [source], embed_backend)
+
+def remove_sources_from_vectorstore(vectorstore, sources: list[str], embed_backend: Optional[str] = None) -> int:
+    """여러 출처의 청크를 한 번에 삭제합니다 (인덱스 재구성·저장은 한 번만)."""
+    return _remove_sources(vectorstore, sources, embed_backend)[1]
+
+def _remove_sources(vectorstore, sources: list[str], embed_backend: Optional[str] = None) -> tuple:
+    """remove_sources_from_vectorstore 본체. (레지스트리에 등록된 벡터스토어, 삭제한 청크 수)"""
+    _ensure_writable(vectorstore)
+    embed_backend = _store_backend(vectorstore, embed_backend)
+    sources = set(sources)
+    ids, indexed = [], set()
+    for _id, doc in _iter_docstore(vectorstore):
+        indexed.add(doc.metadata.get("file_key", ""))
+        if doc.metadata.get("source") in sources:
+            ids.append(_id)
+    if ids:
+        _delete_from_vectorstore(vectorstore, ids)
+        vectorstore = _persist_after_update(vectorstore, embed_backend, previous=corpus_fingerprint(indexed))
+    return vectorstore, len(ids)
+
+def _persist_after_update(vectorstore, embed_backend: str, previous: Optional[str] = None):
+    """수정한 인덱스를 새 지문으로 등록·저장하고, 수정 전 지문(previous)의 저장본은 지웁니다.
+
+    레지스트리에 같은 지문의 벡터스토어가 이미 있으면 (다른 세션이 같은 코퍼스를 만든 경우) 저장하지 않고
+    그 인스턴스를 돌려줍니다. 호출한 쪽은 반환값을 세션에 붙여야 세션끼리 같은 인스턴스를 공유합니다.
+    """
+    adapt_vectorstore_index(vectorstore)
+    fingerprint = vectorstore_fingerprint(vectorstore)
+    registered = _VS_REGISTRY.put(fingerprint, vectorstore)
+    if registered is not vectorstore:
+        return registered
+    try:
+        save_vectorstore(vectorstore, fingerprint, embed_backend, sources=vectorstore_sources(vectorstore),
+                         replaces=previous)
+    except Exception:
+        logger.warning("수정한 인덱스를 저장하지 못했습니다: %s", fingerprint, exc_info=True)
+    return vectorstore
+
+# 백그라운드 인제스트 작업 (페이지를 막지 않고 사이드바에서 진행 상황만 확인)
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "2"))
+INGEST_JOB_TTL_SEC = 3600  # 끝난 뒤 아무도 가져가지 않은 작업을 보관하는 시간
+
+class IngestJob:
+    """인제스트 작업 하나의 상태. status: queued → running → done | failed | cancelled"""
+    def __init__(self, kind: str, sources: list[str]):
+        self.id = hashlib.sha1(f"{time.time_ns()}-{random.random()}".encode()).hexdigest()[:12]
+        self.kind = kind
+        self.sources = sources
+        self.status = "queued"
+        self.stats: dict = {}
+        self.result = None
+        self.error: Optional[str] = None
+        self.cancel_event = threading.Event()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def fraction(self) -> float:
+        return float(self.stats.get("fraction", 0.0))
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+class IngestJobRunner:
+    """프로세스 공용 스레드 풀에서 인제스트 작업을 실행하고 id로 상태를 조회하게 해 줍니다."""
+    def __init__(self, max_workers: int = INGEST_JOB_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="ingest")
+        self._jobs: dict[str, IngestJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, sources: list[str], fn) -> IngestJob:
+        """fn(job)을 백그라운드에서 실행합니다. fn의 반환값이 job.result가 됩니다."""
+        job = IngestJob(kind, sources)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job: IngestJob, fn) -> None:
+        if job.cancel_event.is_set():
+            job.status, job.finished_at = "cancelled", time.time()
+            return
+        job.status = "running"
+        try:
+            job.result = fn(job)
+            job.status = "done"
+        except IngestCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        job.finished_at = time.time()
+
+    def get(self, job_id: Optional[str]) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id: str) -> None:
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+
+    def pop(self, job_id: str) -> Optional[IngestJob]:
+        """끝난 작업을 꺼내 목록에서 지웁니다 (결과를 세션으로 넘긴 뒤 호출)."""
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def _prune(self) -> None:
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values()
+                       if j.finished_at is not None and now - j.finished_at > INGEST_JOB_TTL_SEC]:
+            del self._jobs[job_id]
+
+_INGEST_JOBS: Optional[IngestJobRunner] = None
+_INGEST_JOBS_LOCK = threading.Lock()
+
+def get_ingest_job_runner() -> IngestJobRunner:
+    global _INGEST_JOBS
+    with _INGEST_JOBS_LOCK:
+        if _INGEST_JOBS is None:
+            _INGEST_JOBS = IngestJobRunner()
+        return _INGEST_JOBS
+
+def _snapshot_uploads(files: List) -> list:
+    """업로드 객체를 바이트 사본으로 바꿉니다 (Streamlit 재실행 뒤에도 작업 스레드에서 읽을 수 있도록)."""
+    out = []
+    for name, data in _read_uploads(files):
+        buf = io.BytesIO(data)
+        buf.name = name
+        out.append(buf)
+    return out
+
+def submit_build_job(files: List, embed_backend: str = "openai") -> IngestJob:
+    """build_vectorstore_from_pdfs를 백그라운드 작업으로 실행합니다. 결과는 벡터스토어.
+
+    작업 스레드에서 카테고리별 퀴즈 컨텍스트까지 미리 계산해 두므로 넘겨받은 뒤엔 검색 지연이 없습니다.
+    """
+    snapshot = _snapshot_uploads(files)
+
+    def _build(job):
+        vs = build_vectorstore_from_pdfs(snapshot, embed_backend, progress=job.stats.update, cancel=job.cancel_event)
+        precompute_category_contexts(vs)
+        return vs
+
+    return get_ingest_job_runner().submit("build", [f.name for f in snapshot], _build)
+
+def submit_add_job(vectorstore, files: List, embed_backend: Optional[str] = None) -> IngestJob:
+    """add_pdfs_to_vectorstore를 백그라운드 작업으로 실행합니다. 결과는 (새 벡터스토어, 추가된 파일명 리스트)이며,
+    새 벡터스토어는 레지스트리에 등록된 인스턴스입니다 (같은 코퍼스를 다른 세션이 이미 만들었으면 그것).
+
+    다른 세션과 공유하는 vectorstore는 그대로 두고, 작업 스레드에서 clone_vectorstore() 사본을 만들어 추가합니다.
+    """
+    snapshot = _snapshot_uploads(files)
+
+    def _add(job):
+        _store_backend(vectorstore, embed_backend)  # 백엔드가 다르면 사본을 만들기 전에 실패
+        vs, added = _add_pdfs(clone_vectorstore(vectorstore), snapshot, embed_backend,
+                              progress=job.stats.update, cancel=job.cancel_event)
+        if added:
+            precompute_category_contexts(vs)
+        return vs, added
+
+    return get_ingest_job_runner().submit("add", [f.name for f in snapshot], _add)
+
+def submit_remove_job(vectorstore, sources: list[str]) -> IngestJob:
+    """remove_source_from_vectorstore를 백그라운드 작업으로 실행합니다. 결과는 (새 벡터스토어, 삭제한 청크 수).
+
+    submit_add_job처럼 작업 스레드에서 사본을 만들어 지우고, 인덱스 재구성·저장까지 끝낸 뒤 넘겨줍니다.
+    """
+    sources = list(sources)
+
+    def _remove(job):
+        vs, removed = _remove_sources(clone_vectorstore(vectorstore), sources)
+        if removed:
+            precompute_category_contexts(vs)
+        return vs, removed
+
+    return get_ingest_job_runner().submit("remove", sources, _remove)
 
 def message(content: str, is_user: bool = False, key: str | None = None, avatar_style: str | None = None):
     """
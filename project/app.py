@@ -1,19 +1,129 @@
 import streamlit as st
-from LLM import build_vectorstore_from_pdfs
+from LLM import (
+    load_latest_vectorstore,
+    cached_vectorstore_sources,
+    vectorstore_backend,
+    embedding_cache_stats,
+    query_cache_stats,
+    attach_session_vectorstore,
+    get_vectorstore_registry,
+    get_ingest_job_runner,
+    submit_build_job,
+    submit_add_job,
+    submit_remove_job,
+)
+
+# 세션 첫 실행 시 디스크에 저장된 최근 인덱스를 불러옴 (재시작/새 탭에서도 재임베딩 없이 사용)
+if "vectorstore" not in st.session_state and not st.session_state.get("vectorstore_restored"):
+    st.session_state.vectorstore_restored = True
+    _fp, _vs = load_latest_vectorstore()
+    if _vs is not None:
+        attach_session_vectorstore(st.session_state, _vs)
+        st.sidebar.caption(f"저장된 인덱스 불러옴 ({_fp[:8]})")
 
 uploaded = st.sidebar.file_uploader("PDF 업로드 (여러 개)", type=["pdf"], accept_multiple_files=True)
-embed_backend = st.sidebar.selectbox("임베딩 백엔드", ["openai", "gemini"], index=0)
+# 불러온 인덱스가 있으면 그 인덱스를 만든 백엔드를 기본값으로 (증분 추가/삭제는 인덱스의 백엔드만 허용)
+_backends = ["openai", "gemini", "local"]
+_vs_backend = vectorstore_backend(st.session_state.vectorstore) if "vectorstore" in st.session_state else None
+embed_backend = st.sidebar.selectbox("임베딩 백엔드", _backends,
+                                     index=_backends.index(_vs_backend) if _vs_backend in _backends else 0)
+
+# 인제스트는 백그라운드 작업으로 돌리고, 사이드바는 진행 상황만 주기적으로 확인 (그동안 페이지는 계속 사용 가능)
+_jobs = get_ingest_job_runner()
+_JOB_LABELS = {"build": "임베딩", "add": "추가", "remove": "제거"}
+_job = _jobs.get(st.session_state.get("ingest_job_id"))
 
-if st.sidebar.button("임베딩 생성", use_container_width=True):
+if st.sidebar.button("임베딩 생성", use_container_width=True, disabled=_job is not None):
     if not uploaded:
         st.sidebar.warning("PDF를 먼저 업로드하세요.")
     else:
-        try:
-            st.session_state.vectorstore = build_vectorstore_from_pdfs(uploaded, embed_backend)
-            st.sidebar.success("벡터스토어 생성 완료")
-            st.session_state.pop("qa_chain", None)
-        except Exception as e:
-            st.sidebar.error(f"임베딩 실패: {e}")
+        st.session_state.ingest_job_id = submit_build_job(uploaded, embed_backend).id
+        st.rerun()
+
+
+@st.fragment(run_every=1.0)
+def _ingest_job_status():
+    job = _jobs.get(st.session_state.get("ingest_job_id"))
+    if job is None:
+        return
+    if not job.finished:
+        if job.kind == "remove":
+            # 삭제는 인덱스 재구성·저장까지 짧게 끝나므로 취소 없이 진행만 표시
+            st.progress(job.fraction, text="문서 제거 중...")
+            return
+        s = job.stats
+        label = "인덱스 생성" if job.kind == "build" else "문서 추가"
+        st.progress(job.fraction, text=f"{label} 중 · 청크 {s['chunks']}개 · {s['chunks_per_sec']:.0f} chunks/s"
+                    if s else "임베딩 준비 중...")
+        if st.button("작업 취소", use_container_width=True, disabled=job.cancel_event.is_set()):
+            _jobs.cancel(job.id)
+        return
+
+    # 끝난 작업의 결과를 세션으로 넘기고 전체 페이지를 다시 그림
+    _jobs.pop(job.id)
+    st.session_state.pop("ingest_job_id", None)
+    notices = []
+    if job.status == "done" and job.kind == "build":
+        attach_session_vectorstore(st.session_state, job.result)
+        notices.append(("success", "벡터스토어 생성 완료"))
+        if job.stats:
+            notices.append(("caption", f"분할 {job.stats['chunk_mode']} · 임베딩 토큰 {job.stats['tokens_embedded']:,}개"))
+            for name, n in job.stats["dropped_per_file"].items():
+                notices.append(("caption", f"중복 청크 제외: {name} {n}개"))
+            for name, ps in job.stats["page_stats"].items():
+                notices.append(("caption", f"{name}: 페이지 추출 {ps['extracted']} · 캐시 {ps['cached']} · "
+                                           f"텍스트 없음 {ps['skipped']} ({ps['seconds']:.1f}s)"))
+        stats = embedding_cache_stats()
+        if stats:
+            notices.append(("caption", f"임베딩 캐시 적중 {stats['hits']} / 미스 {stats['misses']} (저장 {stats['entries']}개)"))
+    elif job.status == "done" and job.kind == "remove":
+        vs, removed = job.result
+        if removed:
+            attach_session_vectorstore(st.session_state, vs)
+        notices.append(("success", f"청크 {removed}개 제거 완료"))
+    elif job.status == "done":
+        vs, added = job.result
+        if added:
+            attach_session_vectorstore(st.session_state, vs)
+            notices.append(("success", f"{len(added)}개 문서 추가 완료"))
+        else:
+            notices.append(("info", "새로 추가할 문서가 없습니다."))
+    elif job.status == "cancelled":
+        notices.append(("info", "작업을 취소했습니다. (끝난 파일은 캐시에 남아 다음에 빨리 처리됩니다)"))
+    else:
+        notices.append(("error", f"{_JOB_LABELS[job.kind]} 실패: {job.error}"))
+    st.session_state.ingest_notices = notices
+    st.rerun()
+
+
+if _job is not None:
+    with st.sidebar:
+        _ingest_job_status()
+for _kind, _text in st.session_state.pop("ingest_notices", []):
+    getattr(st.sidebar, _kind)(_text)
+
+# 증분 추가/삭제: 새로 올린 PDF만 임베딩하고, 빠진 문서는 청크만 삭제
+if "vectorstore" in st.session_state:
+    if st.sidebar.button("업로드 PDF 추가 (증분)", use_container_width=True, disabled=_job is not None):
+        if not uploaded:
+            st.sidebar.warning("PDF를 먼저 업로드하세요.")
+        else:
+            # 다른 세션과 공유하는 인덱스이므로 작업이 사본을 만들어 추가
+            st.session_state.ingest_job_id = submit_add_job(st.session_state.vectorstore, uploaded, embed_backend).id
+            st.rerun()
+
+    with st.sidebar.expander("인덱스 문서 관리", expanded=False):
+        to_remove = st.multiselect("제거할 문서", cached_vectorstore_sources(st.session_state.vectorstore))
+        if st.button("선택 문서 제거", use_container_width=True, disabled=not to_remove or _job is not None):
+            st.session_state.ingest_job_id = submit_remove_job(st.session_state.vectorstore, to_remove).id
+            st.rerun()
+        shared = get_vectorstore_registry().stats()
+        lease = st.session_state.get("vectorstore_lease")
+        st.caption(f"메모리의 공유 인덱스 {len(shared)}개 · 이 코퍼스 사용 세션 "
+                   f"{shared.get(lease.fingerprint, 0) if lease else 0}개")
+        qstats = query_cache_stats()
+        st.caption(f"질의 임베딩 캐시 적중률 {qstats['hit_rate']:.0%} "
+                   f"({qstats['hits']}/{qstats['hits'] + qstats['misses']}, 보관 {qstats['entries']}개)")
 
 page_main = st.Page("main.py", title="main Page", icon="🖥️")
 page_2 = st.Page("1.py", title="1.포토리소그래피", icon="📟")
@@ -0,0 +1,326 @@
+"""인제스트/검색 벤치마크 (명령줄 전용, Streamlit 페이지 아님).
+
+    python bench.py recall 강의1.pdf 강의2.pdf --backend openai --k 10
+    python bench.py ingest --files 4 --pages 50 --lang mixed --repeat 3 --out bench.jsonl
+
+recall: PDF들을 인제스트(캐시 사용)해 얻은 전체 정밀도 벡터로, 축소 차원/PCA/양자화 설정별
+        recall@k와 벡터당 바이트를 JSON 한 줄씩 출력합니다 (LLM.storage_recall_report 참고).
+ingest: 네트워크/API 키 없이 돌아가는 오프라인 인제스트 벤치마크. 합성 한/영 PDF를 만들고
+        결정적 가짜 임베딩(--embedder fake) 또는 로컬 해싱 임베딩(--embedder local)으로
+        build_vectorstore_from_pdfs를 실행해 pages/sec, chunks/sec,
+        임베딩 호출 수, 최대 RSS, 인덱스 구축 시간을 실행마다 JSON 한 줄로 출력합니다.
+        매 실행은 빈 임시 캐시 디렉터리에서 시작하므로 항상 콜드 인제스트를 잽니다.
+"""
+import os
+import io
+import gc
+import sys
+import json
+import time
+import zlib
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import LLM
+
+
+def _payloads(paths: list[str]) -> list[tuple[str, bytes]]:
+    out = []
+    for p in paths:
+        with open(p, "rb") as f:
+            out.append((os.path.basename(p), f.read()))
+    return out
+
+
+def cmd_recall(args) -> None:
+    payloads = _payloads(args.pdf)
+    keys = [LLM._ingest_cache_key(data, args.backend) for _, data in payloads]
+    # 스트리밍 인제스트 결과는 float32 flat 인덱스이므로 원래 벡터를 그대로 꺼낼 수 있음
+    vs = LLM._run_ingest(None, payloads, keys, LLM.get_embedding(args.backend))
+    if vs is None:
+        sys.exit("PDF에서 추출한 텍스트가 없습니다.")
+    vectors = LLM._index_vectors(vs.index)
+    print(json.dumps({"vectors": len(vectors), "dim": int(vectors.shape[1])}, ensure_ascii=False))
+    for row in LLM.storage_recall_report(vectors, k=args.k, n_queries=args.queries):
+        print(json.dumps(row, ensure_ascii=False))
+
+
+# 합성 PDF: 폰트를 임베드하지 않은 Type0(Identity-H) 폰트에 ToUnicode CMap만 붙여,
+# 코드 = 유니코드 코드포인트로 한글/영문을 그대로 쓰고 pypdf가 텍스트를 복원할 수 있게 함
+_KO_WORDS = ["포토리소그래피", "감광제", "노광", "현상", "식각", "건식", "습식", "플라즈마", "산화막",
+             "열산화", "확산", "도펀트", "이온주입", "어닐링", "증착", "화학기상증착", "스퍼터링", "금속배선",
+             "구리", "평탄화", "CMP", "웨이퍼", "수율", "선폭", "마스크", "정렬", "공정", "조건", "온도", "압력"]
+_KO_ENDINGS = ["을 조절한다.", "이 중요하다.", "의 균일도를 높인다.", "에 따라 달라진다.", "을 측정한다.",
+               "과 관련이 있다.", "을 최소화해야 한다."]
+_EN_WORDS = ["lithography", "photoresist", "exposure", "develop", "etch", "plasma", "oxide", "thermal",
+             "diffusion", "dopant", "implant", "anneal", "deposition", "CVD", "sputtering", "metal",
+             "copper", "planarization", "wafer", "yield", "critical", "dimension", "mask", "alignment",
+             "process", "uniformity", "temperature", "pressure", "selectivity", "throughput"]
+
+
+def _synthetic_line(rng: random.Random, lang: str) -> str:
+    if lang == "mixed":
+        lang = rng.choice(["ko", "en"])
+    if lang == "ko":
+        words = rng.sample(_KO_WORDS, rng.randint(3, 6))
+        return " ".join(words) + rng.choice(_KO_ENDINGS)
+    words = rng.sample(_EN_WORDS, rng.randint(6, 11))
+    return " ".join(words).capitalize() + "."
+
+
+def _pdf_code(c: str) -> int:
+    return ord(c) if ord(c) < 0x10000 else 0xFFFD
+
+
+def _pdf_hex(text: str) -> str:
+    return "<" + "".join(f"{_pdf_code(c):04X}" for c in text) + ">"
+
+
+def make_synthetic_pdf(pages: int, lang: str = "mixed", seed: int = 0, lines_per_page: int = 40,
+                       blank_every: int = 0, title: str = "Synthetic") -> bytes:
+    """결정적인 합성 PDF 바이트를 만듭니다.
+
+    Args:
+        pages: 페이지 수
+        lang: "ko" | "en" | "mixed" (줄마다 한/영 무작위)
+        seed: 같은 seed면 같은 바이트
+        lines_per_page: 페이지당 본문 줄 수
+        blank_every: n > 0이면 n번째 페이지마다 텍스트 없는 (도형만 있는) 페이지
+        title: 페이지마다 반복되는 머리말 (중복 제거 경로를 태우기 위함)
+    """
+    rng = random.Random(seed)
+    objs: list[bytes] = []
+
+    def add(body: bytes) -> int:
+        objs.append(body)
+        return len(objs)
+
+    def stream(data: bytes, extra: str = "") -> bytes:
+        data = zlib.compress(data)
+        return f"<< /Length {len(data)} /Filter /FlateDecode {extra}>>\nstream\n".encode() + data + b"\nendstream"
+
+    # 페이지 텍스트를 먼저 만들고, ToUnicode CMap에는 실제로 쓴 코드만 넣음 (전체 0000–FFFF 범위를 넣으면
+    # pypdf가 CMap 파싱에 대부분의 시간을 써서 인제스트가 아니라 폰트 파싱을 재게 됨)
+    page_lines: list = []
+    for n in range(pages):
+        if blank_every > 0 and (n + 1) % blank_every == 0:
+            page_lines.append(None)
+        else:
+            page_lines.append([f"{title} - {n + 1}"] + [_synthetic_line(rng, lang) for _ in range(lines_per_page)])
+    codes = sorted({_pdf_code(c) for lines in page_lines if lines for line in lines for c in line})
+    cmap = ["/CIDInit /ProcSet findresource begin", "12 dict begin", "begincmap",
+            "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+            "/CMapName /Adobe-Identity-UCS def", "/CMapType 2 def",
+            "1 begincodespacerange <0000> <FFFF> endcodespacerange"]
+    for lo in range(0, len(codes), 100):  # bfchar 블록은 100개까지
+        block = codes[lo:lo + 100]
+        cmap.append(f"{len(block)} beginbfchar")
+        cmap += [f"<{c:04X}> <{c:04X}>" for c in block]
+        cmap.append("endbfchar")
+    cmap += ["endcmap", "CMapName currentdict /CMap defineresource pop", "end", "end"]
+    to_unicode = add(stream("\n".join(cmap).encode()))
+    descriptor = add(b"<< /Type /FontDescriptor /FontName /SyntheticGothic /Flags 4 /FontBBox [0 -200 1000 900] "
+                     b"/ItalicAngle 0 /Ascent 900 /Descent -200 /CapHeight 700 /StemV 80 >>")
+    cid_font = add(f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /SyntheticGothic "
+                   f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+                   f"/FontDescriptor {descriptor} 0 R /DW 1000 /CIDToGIDMap /Identity >>".encode())
+    font = add(f"<< /Type /Font /Subtype /Type0 /BaseFont /SyntheticGothic /Encoding /Identity-H "
+               f"/DescendantFonts [{cid_font} 0 R] /ToUnicode {to_unicode} 0 R >>".encode())
+    pages_id = len(objs) + 1 + 2 * pages  # 페이지 객체들 뒤에 /Pages
+    kids = []
+    for lines in page_lines:
+        if lines is None:
+            content = b"0.8 g 72 72 451 698 re f"
+        else:
+            ops = ["BT", "/F1 10 Tf", "14 TL", "50 800 Td"]
+            for line in lines:
+                ops += [f"{_pdf_hex(line)} Tj", "T*"]
+            ops.append("ET")
+            content = "\n".join(ops).encode()
+        contents = add(stream(content))
+        kids.append(add(f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 595 842] "
+                        f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {contents} 0 R >>".encode()))
+    add(f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {pages} >>".encode())
+    catalog = add(f"<< /Type /Catalog /Pages {pages_id} 0 R >>".encode())
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for i, body in enumerate(objs, 1):
+        offsets.append(out.tell())
+        out.write(f"{i} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode())
+    out.write("".join(f"{o:010d} 00000 n \n" for o in offsets).encode())
+    out.write(f"trailer\n<< /Size {len(objs) + 1} /Root {catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+class FakeEmbeddings(Embeddings):
+    """텍스트 해시를 시드로 쓰는 결정적 가짜 임베딩 (네트워크 없음).
+
+    batch_size개씩 끊어 한 번의 API 호출로 세고, latency_ms를 주면 호출마다 그만큼 쉬어
+    실제 백엔드의 왕복 시간을 흉내 냅니다. inner를 지정하면 벡터는 inner가 계산합니다.
+    """
+    inner = None
+
+    def __init__(self, dim: int = 1536, batch_size: int = 512, latency_ms: float = 0.0):
+        self.dim = dim
+        self.batch_size = max(1, batch_size)
+        self.latency_ms = latency_ms
+        self.calls = 0
+        self.texts = 0
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        v = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (v / np.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        out = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i:i + self.batch_size]
+            self.calls += 1
+            self.texts += len(batch)
+            if self.latency_ms > 0:
+                time.sleep(self.latency_ms / 1000.0)
+            if self.inner is not None:
+                out.extend(self.inner.embed_documents(batch))
+            else:
+                out.extend(self._vector(t) for t in batch)
+        return out
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _isolate_caches(root: str) -> None:
+    """인제스트/페이지/인덱스 캐시를 root 아래로 돌립니다 (포크된 파싱 워커에도 적용되도록 환경변수도 설정)."""
+    paths = {"INGEST_CACHE_DIR": os.path.join(root, "ingest"),
+             "VECTORSTORE_DIR": os.path.join(root, "faiss"),
+             "PAGE_TEXT_CACHE_PATH": os.path.join(root, "pages.sqlite")}
+    for name, path in paths.items():
+        os.environ[name] = path
+        setattr(LLM, name, path)
+    for conn, _lock in LLM._PAGE_CACHE_CONN.values():
+        conn.close()
+    LLM._PAGE_CACHE_CONN.clear()
+
+
+def _peak_rss_mb() -> dict:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return {"peak_rss_mb": None, "peak_rss_children_mb": None}
+    # 리눅스는 KB, macOS는 바이트 단위
+    scale = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+    return {"peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1),
+            "peak_rss_children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1)}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+def cmd_ingest(args) -> None:
+    files = []
+    for i in range(args.files):
+        data = make_synthetic_pdf(args.pages, lang=args.lang, seed=args.seed + i,
+                                  lines_per_page=args.lines, blank_every=args.blank_every)
+        f = io.BytesIO(data)
+        f.name = f"synthetic_{args.seed + i}.pdf"
+        files.append(f)
+    config = {"files": args.files, "pages_per_file": args.pages, "lang": args.lang, "seed": args.seed,
+              "lines_per_page": args.lines, "blank_every": args.blank_every, "workers": args.workers,
+              "embedder": args.embedder, "dim": args.dim, "embed_batch": args.batch, "embed_latency_ms": args.latency_ms,
+              "chunk_mode": LLM.SPLITTER_SETTINGS.get("mode", "char"), "index_type": LLM.FAISS_INDEX_TYPE,
+              "vector_storage": LLM.VECTOR_STORAGE, "dedup_jaccard": LLM.DEDUP_JACCARD,
+              "pdf_mb": round(sum(len(f.getvalue()) for f in files) / (1024 * 1024), 2)}
+    env = {"revision": _git_revision(), "python": platform.python_version(), "cpus": os.cpu_count()}
+    lines = []
+    for run in range(args.repeat):
+        embedding = FakeEmbeddings(dim=args.dim, batch_size=args.batch, latency_ms=args.latency_ms)
+        if args.embedder == "local":
+            # 실제 로컬 임베딩 계산을 재되, 호출 수는 같은 래퍼로 셈
+            embedding.inner = LLM.HashingEmbeddings(dim=args.dim)
+        last: dict = {}
+        with tempfile.TemporaryDirectory(prefix="bench-ingest-") as root:
+            _isolate_caches(root)
+            for f in files:
+                f.seek(0)
+            t0 = time.perf_counter()
+            vs = LLM.build_vectorstore_from_pdfs(files, embed_backend="bench-fake", workers=args.workers,
+                                                 progress=last.update, embedding=embedding)
+            total = time.perf_counter() - t0
+            vectors = vs.index.ntotal
+            layout = LLM.index_layout(vs.index)
+            # 레지스트리가 같은 지문으로 이전 실행 결과를 돌려주지 않도록 바로 놓아줌
+            del vs
+            gc.collect()
+            _isolate_caches(root)  # 페이지 캐시 연결을 닫아 임시 디렉터리를 지울 수 있게 함
+        pages = last.get("pages", 0)
+        row = {"run": run, **config, **env,
+               "seconds": round(total, 3),
+               "pages": pages,
+               "pages_per_sec": round(pages / total, 1) if total > 0 else 0.0,
+               "chunks": last.get("chunks", 0),
+               "chunks_per_sec": round(last.get("chunks", 0) / total, 1) if total > 0 else 0.0,
+               "dropped": last.get("dropped", 0),
+               "vectors": int(vectors),
+               "embedding_calls": embedding.calls,
+               "embedded_texts": embedding.texts,
+               "tokens_embedded": last.get("tokens_embedded", 0),
+               "index_build_s": round(last.get("index_s", 0.0), 3),
+               "index": layout,
+               **_peak_rss_mb()}
+        line = json.dumps(row, ensure_ascii=False)
+        print(line, flush=True)
+        lines.append(line)
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="인제스트/검색 벤치마크")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("recall", help="축소/양자화 저장 설정별 recall@k 비교")
+    p.add_argument("pdf", nargs="+", help="PDF 파일 경로")
+    p.add_argument("--backend", default="openai", choices=["openai", "gemini", "local"])
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--queries", type=int, default=200)
+    p.set_defaults(func=cmd_recall)
+    p = sub.add_parser("ingest", help="합성 PDF + 가짜 임베딩으로 오프라인 인제스트 처리량 측정")
+    p.add_argument("--files", type=int, default=3, help="합성 PDF 개수")
+    p.add_argument("--pages", type=int, default=40, help="파일당 페이지 수")
+    p.add_argument("--lines", type=int, default=40, help="페이지당 본문 줄 수")
+    p.add_argument("--lang", default="mixed", choices=["ko", "en", "mixed"])
+    p.add_argument("--blank-every", type=int, default=0, help="n번째 페이지마다 텍스트 없는 페이지 (0이면 없음)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--workers", type=int, default=None, help="PDF 파싱 워커 수 (기본은 PDF_PARSE_WORKERS)")
+    p.add_argument("--embedder", default="fake", choices=["fake", "local"],
+                   help="fake: 해시 시드 난수 벡터 / local: LLM.HashingEmbeddings")
+    p.add_argument("--dim", type=int, default=1536, help="임베딩 차원")
+    p.add_argument("--batch", type=int, default=512, help="임베딩 호출 1회당 텍스트 수")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="임베딩 호출 1회당 지연 (API 왕복 흉내)")
+    p.add_argument("--repeat", type=int, default=1, help="반복 실행 횟수 (매번 콜드 캐시)")
+    p.add_argument("--out", default="", help="결과 JSON 줄을 덧붙일 파일 (회귀 추적용)")
+    p.set_defaults(func=cmd_ingest)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
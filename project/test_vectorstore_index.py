@@ -0,0 +1,100 @@
+"""FAISS 인덱스 생성/삭제 회귀 테스트 (네트워크 없이 고정 벡터 사용). 실행: project에서 python -m pytest -q"""
+import numpy as np
+import pytest
+
+import LLM
+
+pytestmark = pytest.mark.skipif(not (LLM.HAS_FAISS and LLM.HAS_VS), reason="faiss / langchain-community 필요")
+
+DIM = 32
+
+
+class LookupEmbeddings(LLM.Embeddings):
+    """텍스트 → 미리 정한 벡터 (질의도 같은 표에서 찾음)."""
+    def __init__(self, table: dict):
+        self.table = table
+
+    def embed_documents(self, texts):
+        return [self.table[t].tolist() for t in texts]
+
+    def embed_query(self, text):
+        return self.table[text].tolist()
+
+
+def _store(n: int, kind: str, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n, DIM)).astype(np.float32)
+    texts = [f"chunk {i}" for i in range(n)]
+    metadatas = [{"source": "a.pdf" if i % 3 == 0 else "b.pdf", "file_key": "a" if i % 3 == 0 else "b"}
+                 for i in range(n)]
+    vs = LLM.FAISS.from_embeddings(list(zip(texts, vectors.tolist())), LookupEmbeddings(dict(zip(texts, vectors))),
+                                   metadatas=metadatas, ids=[f"id-{i}" for i in range(n)])
+    vs.index = LLM.make_faiss_index(vectors, kind, storage="float32", pca_dim=0)
+    return vs, texts
+
+
+@pytest.mark.parametrize("kind", ["flat", "hnsw", "ivfpq"])
+def test_delete_keeps_positions_aligned_with_docstore(kind):
+    vs, texts = _store(390, kind)
+    before = LLM._index_vectors(vs.index).copy()
+    drop = [f"id-{i}" for i in range(390) if i % 3 == 0]
+    LLM._delete_from_vectorstore(vs, drop)
+
+    keep = [i for i in range(390) if i % 3]
+    assert vs.index.ntotal == len(keep)
+    assert sorted(vs.index_to_docstore_id) == list(range(len(keep)))
+    # 남은 위치 p의 벡터는 삭제 전 keep[p]의 벡터 (IVF-PQ도 같은 코드에서 복원되므로 정확히 같음)
+    if kind != "hnsw":
+        np.testing.assert_allclose(LLM._index_vectors(vs.index), before[keep], rtol=1e-5, atol=1e-5)
+
+    # 남은 청크의 벡터로 검색하면 그 청크가 (PQ 근사를 감안해) 상위에 나오고, 삭제한 청크는 나오지 않음
+    queries = [texts[i] for i in keep[::10]]
+    found = LLM.search_many(vs, queries, k=5, mode="dense")
+    for q, docs in zip(queries, found):
+        contents = [d.page_content for d in docs]
+        assert all(d.metadata["source"] == "b.pdf" for d in docs)
+        assert q in contents
+
+
+def test_delete_then_search_all_positions_resolve():
+    vs, texts = _store(390, "ivfpq")
+    LLM._delete_from_vectorstore(vs, [f"id-{i}" for i in range(36)])
+    positions = LLM._dense_positions_many(vs, np.stack([vs.embeddings.table[t] for t in texts[36:]]), 10)
+    assert all(0 <= p < vs.index.ntotal for row in positions for p in row)
+    assert [d.page_content for d in LLM._docs_at(vs, [0])] == ["chunk 36"]
+
+
+@pytest.mark.parametrize("n", [0, 1, 89, 255])
+def test_ivfpq_falls_back_below_codebook_size(n):
+    x = np.random.default_rng(0).standard_normal((n, DIM)).astype(np.float32)
+    index = LLM.make_faiss_index(x, "ivfpq", storage="float32", pca_dim=0)
+    assert LLM.index_type(index) == "flat"
+    assert index.ntotal == n
+
+
+def test_adapt_small_store_to_forced_ivfpq_is_stable():
+    vs, texts = _store(89, "flat")
+    assert LLM.adapt_vectorstore_index(vs, "ivfpq") == "flat"
+    index = vs.index
+    assert LLM.adapt_vectorstore_index(vs, "ivfpq") == "flat"
+    assert vs.index is index  # 매번 다시 만들지 않음
+    assert texts[5] in [d.page_content for d in LLM.search_many(vs, [texts[5]], k=3, mode="dense")[0]]
+
+
+def test_ivfpq_builds_at_codebook_size():
+    x = np.random.default_rng(0).standard_normal((256, DIM)).astype(np.float32)
+    index = LLM.make_faiss_index(x, "ivfpq", storage="float32", pca_dim=0)
+    assert LLM.index_type(index) == "ivfpq"
+    assert index.ntotal == 256
+
+
+@pytest.mark.parametrize("kind", ["hnsw", "ivfpq"])
+def test_search_params_are_per_query(kind):
+    vs, texts = _store(390, kind)
+    core = LLM._core_index(vs.index)
+    before = core.hnsw.efSearch if kind == "hnsw" else core.nprobe
+    wide = LLM.search_many(vs, texts[:20], k=3, mode="dense", ef_search=400, nprobe=1000)
+    narrow = LLM.search_many(vs, texts[:20], k=3, mode="dense", ef_search=1, nprobe=1)
+    assert (core.hnsw.efSearch if kind == "hnsw" else core.nprobe) == before
+    assert all(len(docs) == 3 for docs in wide + narrow)
+    assert all(q in [d.page_content for d in docs] for q, docs in zip(texts[:20], wide))